@@ -1,45 +1,204 @@
 import os
 import json
-import time
 import re
 import random
+import asyncio
+import threading
 import functools
 from dotenv import load_dotenv
-from gigachat import GigaChat
-import requests
-from requests.adapters import HTTPAdapter
-from requests.packages.urllib3.util.retry import Retry
+from llm_client import LLMClient, LLMError, CircuitBreaker, LatencyTracker, ModelRouter, call_tags
 
 # Загрузка переменных окружения
 load_dotenv()
 GIGACHAT_API_KEY = os.getenv("GIGACHAT_API_KEY")
-if not GIGACHAT_API_KEY:
-    raise ValueError("GIGACHAT_API_KEY не найден. Проверьте файл .env и переменную GIGACHAT_API_KEY.")
 
+# Модель по умолчанию и таймаут одного HTTP-запроса к GigaChat, с
+LLM_MODEL = os.getenv("LLM_MODEL", "GigaChat-Max")
+LLM_REQUEST_TIMEOUT = float(os.getenv("LLM_REQUEST_TIMEOUT", "300"))
 
-class TimeoutHTTPAdapter(HTTPAdapter):
-    def __init__(self, timeout, *args, **kwargs):
-        self.timeout = timeout
-        super().__init__(*args, **kwargs)
+# Клиенты GigaChat (по одному на модель) создаются при первом вызове модели: страницы без нейросети
+# (и процессы, которые её не используют) не импортируют SDK и не требуют ключа.
+# giga, если задан (нагрузочный тест), подменяет клиентов всех моделей
+giga = None
+giga_clients = {}
+_giga_lock = threading.Lock()
 
-    def send(self, request, **kwargs):
-        if "timeout" not in kwargs or kwargs["timeout"] is None:
-            kwargs["timeout"] = self.timeout
-        return super().send(request, **kwargs)
 
+def get_giga(model=None):
+    if giga is not None:
+        return giga
+    model = model or LLM_MODEL
+    with _giga_lock:
+        client = giga_clients.get(model)
+        if client is None:
+            if not GIGACHAT_API_KEY:
+                raise LLMError("GIGACHAT_API_KEY не найден. Проверьте файл .env и переменную GIGACHAT_API_KEY.")
+            from gigachat import GigaChat
+            client = giga_clients[model] = GigaChat(
+                credentials=GIGACHAT_API_KEY,
+                model=model,
+                timeout=LLM_REQUEST_TIMEOUT,
+                verify_ssl_certs=False
+            )
+        return client
 
-# Инициализация клиента GigaChat
-giga = GigaChat(
-    credentials=GIGACHAT_API_KEY,
-    model="GigaChat-Max",
-    verify_ssl_certs=False
+# Общий клиент с повторами: дедлайн (бюджет времени) на вызов (с), число попыток и порог circuit breaker
+LLM_DEADLINES = {
+    "generate_material": float(os.getenv("LLM_DEADLINE_MATERIAL", "600")),
+    "generate_questions": float(os.getenv("LLM_DEADLINE_QUESTIONS", "300")),
+    "evaluate_answers": float(os.getenv("LLM_DEADLINE_EVALUATE", "180")),
+    "evaluate_result": float(os.getenv("LLM_DEADLINE_EVALUATE", "180")),
+}
+llm = LLMClient(
+    get_giga,
+    breaker=CircuitBreaker(
+        failure_threshold=int(os.getenv("LLM_BREAKER_THRESHOLD", "5")),
+        reset_timeout=float(os.getenv("LLM_BREAKER_RESET", "30"))
+    ),
+    max_attempts=int(os.getenv("LLM_MAX_ATTEMPTS", "30")),
+    backoff_cap=float(os.getenv("LLM_BACKOFF_CAP", "60"))
 )
 
-if hasattr(giga, "_session"):
-    giga._session.mount("https://", TimeoutHTTPAdapter(timeout=300))
+# Маршрутизация: модель для каждой функции (пусто — LLM_MODEL, "auto" — автоматический выбор)
+# и ограничение длины ответа в токенах (0 — без ограничения); бюджет времени — LLM_DEADLINES.
+# Короткие ответы в строгом формате (оценки) по умолчанию выбираются автоматически
+LLM_ROUTE_MODELS = {
+    "generate_material": os.getenv("LLM_ROUTE_MATERIAL", ""),
+    "generate_questions": os.getenv("LLM_ROUTE_QUESTIONS", ""),
+    "evaluate_answers": os.getenv("LLM_ROUTE_EVALUATE", "auto"),
+    "evaluate_result": os.getenv("LLM_ROUTE_EVALUATE", "auto"),
+}
+LLM_MAX_TOKENS = {
+    "generate_material": int(os.getenv("LLM_MAX_TOKENS_MATERIAL", "0")),
+    "generate_questions": int(os.getenv("LLM_MAX_TOKENS_QUESTIONS", "0")),
+    "evaluate_answers": int(os.getenv("LLM_MAX_TOKENS_EVALUATE", "1024")),
+    "evaluate_result": int(os.getenv("LLM_MAX_TOKENS_EVALUATE", "1024")),
+}
 
+# Автоматический режим: модели от дешёвой к дорогой, целевое p95 длительности вызова (с) по функциям
+# и минимальная доля ответов в ожидаемом формате (RESPONSE_CHECKS)
+LLM_AUTO_MODELS = [m.strip() for m in os.getenv("LLM_AUTO_MODELS", "GigaChat,GigaChat-Pro,GigaChat-Max").split(",") if m.strip()]
+LLM_LATENCY_TARGETS = {
+    "generate_material": float(os.getenv("LLM_TARGET_MATERIAL", "90")),
+    "generate_questions": float(os.getenv("LLM_TARGET_QUESTIONS", "60")),
+    "evaluate_answers": float(os.getenv("LLM_TARGET_EVALUATE", "20")),
+    "evaluate_result": float(os.getenv("LLM_TARGET_EVALUATE", "20")),
+}
+LLM_AUTO_MIN_SUCCESS = float(os.getenv("LLM_AUTO_MIN_SUCCESS", "0.9"))
+LLM_AUTO_EXPLORE = float(os.getenv("LLM_AUTO_EXPLORE", "0.05"))
 
-def generate_material(language, difficulty):
+# Подстраховочные запросы: если модель не ответила за p95 длительности своих успешных вызовов
+# этой функции, тот же запрос параллельно уходит к запасной модели, побеждает первый ответ.
+# Пусто — без подстраховки. Пока замеров меньше LLM_HEDGE_MIN_SAMPLES, порог берётся из LLM_HEDGE_AFTER
+LLM_FALLBACK_MODEL = os.getenv("LLM_FALLBACK_MODEL", "GigaChat-Pro")
+LLM_HEDGE_AFTER = {
+    "generate_material": float(os.getenv("LLM_HEDGE_MATERIAL", "120")),
+    "generate_questions": float(os.getenv("LLM_HEDGE_QUESTIONS", "90")),
+    "evaluate_answers": float(os.getenv("LLM_HEDGE_EVALUATE", "45")),
+    "evaluate_result": float(os.getenv("LLM_HEDGE_EVALUATE", "45")),
+}
+latencies = LatencyTracker(min_samples=int(os.getenv("LLM_HEDGE_MIN_SAMPLES", "20")))
+router = ModelRouter(LLM_AUTO_MODELS, latencies, min_success=LLM_AUTO_MIN_SUCCESS, explore=LLM_AUTO_EXPLORE,
+                     min_samples=int(os.getenv("LLM_AUTO_MIN_SAMPLES", "20")))
+
+# Проверка формата ответа для автоматического режима
+RESPONSE_CHECKS = {
+    "generate_material": lambda text: len(text.strip()) >= 200,
+    "generate_questions": lambda text: len(extract_answer_key(text)) == 10,
+    "evaluate_answers": lambda text: re.search(r"Количество правильных:\s*\d+\s*из\s*\d+", text) is not None,
+    "evaluate_result": lambda text: "Рекомендации:" in text,
+}
+
+
+def observe_call(stats):
+    """Слушатель llm.listeners: длительности успешных вызовов по моделям и ошибки для автоматического режима."""
+    model = stats.model or LLM_MODEL
+    if stats.ok:
+        latencies.observe((stats.name, model), stats.latency)
+    elif not stats.cancelled:
+        router.observe(stats.name, model, False)
+
+
+llm.listeners.append(observe_call)
+
+
+def route_model(name):
+    model = LLM_ROUTE_MODELS[name]
+    if model == "auto":
+        return router.select(name, LLM_LATENCY_TARGETS[name])
+    return model or LLM_MODEL
+
+
+def hedge_after(name, model):
+    return latencies.percentile((name, model), 95, LLM_HEDGE_AFTER[name])
+
+
+async def chat(name, prompt):
+    """
+    Ответ модели по маршруту функции name в пределах бюджета времени LLM_DEADLINES[name]
+    с подстраховкой запасной моделью.
+    """
+    model = route_model(name)
+    text, answered_by = await llm.achat_hedged(name, prompt, LLM_DEADLINES[name], model, LLM_FALLBACK_MODEL,
+                                               hedge_after(name, model), LLM_MAX_TOKENS[name])
+    router.observe(name, answered_by, RESPONSE_CHECKS[name](text))
+    return text
+
+
+# Все асинхронные вызовы GigaChat выполняются в одном фоновом цикле событий процесса:
+# асинхронный httpx-клиент GigaChat привязан к циклу, в котором был создан
+_ai_loop = None
+_ai_loop_pid = None
+_ai_loop_lock = threading.Lock()
+
+
+def ai_loop():
+    global _ai_loop, _ai_loop_pid
+    with _ai_loop_lock:
+        # После fork поток с циклом в дочернем процессе не существует
+        if _ai_loop is None or _ai_loop_pid != os.getpid():
+            _ai_loop = asyncio.new_event_loop()
+            _ai_loop_pid = os.getpid()
+            threading.Thread(target=_ai_loop.run_forever, daemon=True).start()
+        return _ai_loop
+
+
+async def _with_call_tags(tags, coro):
+    """Задача в цикле AI получает call_tags вызывающего потока (пользователь и язык для учёта токенов)."""
+    call_tags.set(tags)
+    return await coro
+
+
+def on_ai_loop(func):
+    """Корутина выполняется в общем цикле AI, откуда бы её ни ожидали."""
+    @functools.wraps(func)
+    async def wrapper(*args, **kwargs):
+        loop = ai_loop()
+        if asyncio.get_running_loop() is loop:
+            return await func(*args, **kwargs)
+        coro = _with_call_tags(call_tags.get(), func(*args, **kwargs))
+        return await asyncio.wrap_future(asyncio.run_coroutine_threadsafe(coro, loop))
+    return wrapper
+
+
+def run_sync(coro):
+    """Выполняет корутину в общем цикле AI и блокирующе ждёт результат."""
+    return asyncio.run_coroutine_threadsafe(_with_call_tags(call_tags.get(), coro), ai_loop()).result()
+
+
+async def _anext(iterator):
+    return await iterator.__anext__()
+
+# Количество вариантов промта для обучающего материала (см. generate_material)
+MATERIAL_PROMPT_VARIANTS = 10
+
+
+def is_generation_error(text):
+    """Проверяет, что функция генерации вернула сообщение об ошибке, а не контент."""
+    return not text or text.startswith("Ошибка при")
+
+
+def material_prompt(language, difficulty, variant=None):
     # 10 вариантов промтов с одинаковым смыслом, но разными формулировками:
     prompt_variants = [
         f"Ты опытный преподаватель программирования. Создай подробный обучающий материал по синтаксису языка {language} для дня {difficulty}. Ответ должен содержать только текст обучающего материала без лишних комментариев. Заключение писать не надо. Писать, какой день тоже не надо.",
@@ -54,32 +213,38 @@ def generate_material(language, difficulty):
         f"Будучи профессионалом в программировании, составь детальный материал по синтаксису {language} для дня {difficulty}. Твой ответ должен содержать только текст обучающего материала, без излишеств, без заключения и без упоминания номера дня."
     ]
 
-    # Выбираем один случайный вариант
-    prompt = random.choice(prompt_variants)
+    # Выбираем заданный вариант (для общего кэша контента) или случайный
+    if variant is None:
+        return random.choice(prompt_variants)
+    return prompt_variants[variant % len(prompt_variants)]
+
+
+@on_ai_loop
+async def agenerate_material(language, difficulty, variant=None):
+    prompt = material_prompt(language, difficulty, variant)
     # print(prompt)
-    max_attempts = 30
-    last_error = None
-    for attempt in range(1, max_attempts + 1):
-        try:
-            response = giga.chat(prompt)
-            return response.choices[0].message.content
-        except Exception as e:
-            last_error = e
-            error_str = str(e)
-            print(f"Попытка {attempt} для generate_material не удалась: {error_str}")
-            if "429" in error_str:
-                wait_time = 60
-                match = re.search(r"Retry-After:\s*(\d+)", error_str)
-                if match:
-                    wait_time = int(match.group(1))
-                print(f"Получен статус 429. Ждем {wait_time} секунд перед следующей попыткой...")
-                time.sleep(wait_time)
-            else:
-                time.sleep(10)
-    return f"Ошибка при генерации обучающего материала после {max_attempts} попыток: {last_error}"
-
-
-def generate_questions(language, material, difficulty):
+    try:
+        return await chat("generate_material", prompt)
+    except LLMError as e:
+        return f"Ошибка при генерации обучающего материала: {e}"
+
+
+async def astream_material(language, difficulty, variant=None):
+    """
+    Потоковая версия generate_material: отдаёт текст по частям по мере генерации.
+    Повторные попытки возможны только до получения первой части ответа.
+    """
+    prompt = material_prompt(language, difficulty, variant)
+    try:
+        async for chunk in llm.astream("generate_material", prompt, LLM_DEADLINES["generate_material"],
+                                       route_model("generate_material"), LLM_MAX_TOKENS["generate_material"]):
+            yield chunk
+    except LLMError as e:
+        raise RuntimeError(f"Ошибка при генерации обучающего материала: {e}") from e
+
+
+@on_ai_loop
+async def agenerate_questions(language, material, difficulty, with_tests=False):
     prompt = (
         f"Ты опытный преподаватель программирования. "
         f"Составь тест из 15 вопросов для изучения синтаксиса языка {language} на основе материала {material} для дня {difficulty}. "
@@ -91,62 +256,43 @@ def generate_questions(language, material, difficulty):
         "   D) Вариант D\n\n"
         "Последние 5 вопросов с 11 по 15 должны быть практическими заданиями без вариантов ответа, "
         "где требуется написать небольшой фрагмент кода. "
-        "Ответ должен содержать только текст теста без дополнительных комментариев."
+        "В самом конце после пустой строки добавь ключ правильных ответов к первым 10 вопросам "
+        "одной строкой в формате:\n"
+        "Ответы: 1-A, 2-C, 3-B, 4-D, 5-A, 6-B, 7-C, 8-D, 9-A, 10-B\n"
+        "Ответ должен содержать только текст теста и строку с ответами без дополнительных комментариев."
     )
-    max_attempts = 10
-    last_error = None
-    for attempt in range(1, max_attempts + 1):
-        try:
-            response = giga.chat(prompt)
-            return response.choices[0].message.content
-        except Exception as e:
-            last_error = e
-            error_str = str(e)
-            print(f"Попытка {attempt} для generate_questions не удалась: {error_str}")
-            if "429" in error_str:
-                wait_time = 60
-                match = re.search(r"Retry-After:\s*(\d+)", error_str)
-                if match:
-                    wait_time = int(match.group(1))
-                print(f"Получен статус 429. Ждем {wait_time} секунд перед следующей попыткой...")
-                time.sleep(wait_time)
-            else:
-                time.sleep(10)
-    return f"Ошибка при генерации тестовых вопросов после {max_attempts} попыток: {last_error}"
-
-
-def evaluate_answers(language, questions_with_answers):
+    if with_tests:
+        # Для языков, код на которых можно выполнить локально (см. sandbox.py)
+        prompt += (
+            "\nПрактические задания 11-15 сформулируй как небольшие программы, которые читают входные данные "
+            "из стандартного ввода и печатают результат. После строки с ответами добавь одной строкой "
+            "по 2-3 теста к каждому заданию в формате JSON:\n"
+            'Тесты: {"11": [{"input": "2 3", "output": "5"}], "12": [...], "13": [...], "14": [...], "15": [...]}'
+        )
+    try:
+        return await chat("generate_questions", prompt)
+    except LLMError as e:
+        return f"Ошибка при генерации тестовых вопросов: {e}"
+
+
+@on_ai_loop
+async def aevaluate_answers(language, questions_with_answers, total=15):
     prompt = (
         f"Ты опытный преподаватель {language}. Проанализируй следующие ответы пользователя по тесту:\n\n"
         f"{questions_with_answers}\n\n"
         "Верни ответ строго в следующем формате (без лишних слов или комментариев):\n\n"
-        "Количество правильных: <число> из 15\n"
+        f"Количество правильных: <число> из {total}\n"
         "Рекомендации: <текст рекомендаций>\n\n"
         "Где <число> – это целое число, отражающее количество правильных ответов, а <текст рекомендаций> – подробные рекомендации по вопросам, вежливо напиши и подбодри от первого лица, которые стоит доучить на основе неверных ответов."
     )
-    max_attempts = 10
-    last_error = None
-    for attempt in range(1, max_attempts + 1):
-        try:
-            response = giga.chat(prompt)
-            return response.choices[0].message.content
-        except Exception as e:
-            last_error = e
-            error_str = str(e)
-            print(f"Попытка {attempt} для evaluate_answers не удалась: {error_str}")
-            if "429" in error_str:
-                wait_time = 60
-                match = re.search(r"Retry-After:\s*(\d+)", error_str)
-                if match:
-                    wait_time = int(match.group(1))
-                print(f"Получен статус 429. Ждем {wait_time} секунд перед следующей попыткой...")
-                time.sleep(wait_time)
-            else:
-                time.sleep(10)
-    return f"Ошибка при проверке ответов после {max_attempts} попыток: {last_error}"
+    try:
+        return await chat("evaluate_answers", prompt)
+    except LLMError as e:
+        return f"Ошибка при проверке ответов: {e}"
 
 
-def evaluate_result(language, correct_percentage, incorrect_percentage):
+@on_ai_loop
+async def aevaluate_result(language, correct_percentage, incorrect_percentage):
     prompt_variants = [
         f"Ты опытный преподаватель {language}. Пользователь завершил тест по изучению синтаксиса {language} с результатом: {correct_percentage}% правильных ответов и {incorrect_percentage}% неправильных ответов. Поздравь его с завершением обучения, похвали за проделанную работу, даже если результат не идеален, и подбодри его. Дай подробные рекомендации по улучшению знаний. Верни ответ строго в следующем формате:\n\nКоличество правильных: <число>%\nРекомендации: <текст рекомендаций>.",
         f"Выполняй роль опытного преподавателя {language}. Пользователь завершил тест по синтаксису {language} и получил {correct_percentage}% правильных и {incorrect_percentage}% неправильных ответов. Пожалуйста, поздравь его, похвали за усилия, подбодри для дальнейшего обучения и дай рекомендации по темам, которые нужно доработать. Выведи ответ строго в следующем формате:\n\nКоличество правильных: <число>%\nРекомендации: <текст рекомендаций>.",
@@ -158,26 +304,39 @@ def evaluate_result(language, correct_percentage, incorrect_percentage):
     # Выбираем один из пяти вариантов промта случайным образом
     prompt = random.choice(prompt_variants)
 
-    max_attempts = 10
-    last_error = None
-    for attempt in range(1, max_attempts + 1):
-        try:
-            response = giga.chat(prompt)
-            return response.choices[0].message.content
-        except Exception as e:
-            last_error = e
-            error_str = str(e)
-            print(f"Попытка {attempt} для evaluate_answers не удалась: {error_str}")
-            if "429" in error_str:
-                wait_time = 60
-                match = re.search(r"Retry-After:\s*(\d+)", error_str)
-                if match:
-                    wait_time = int(match.group(1))
-                print(f"Получен статус 429. Ждем {wait_time} секунд перед следующей попыткой...")
-                time.sleep(wait_time)
-            else:
-                time.sleep(10)
-    return f"Ошибка при проверке ответов после {max_attempts} попыток: {last_error}"
+    try:
+        return await chat("evaluate_result", prompt)
+    except LLMError as e:
+        return f"Ошибка при проверке ответов: {e}"
+
+# Синхронные обёртки для кода, работающего вне цикла событий (Flask-маршруты, фоновые задачи)
+def generate_material(language, difficulty, variant=None):
+    return run_sync(agenerate_material(language, difficulty, variant))
+
+
+def stream_material(language, difficulty, variant=None):
+    chunks = astream_material(language, difficulty, variant)
+    try:
+        while True:
+            try:
+                yield run_sync(_anext(chunks))
+            except StopAsyncIteration:
+                return
+    finally:
+        run_sync(chunks.aclose())
+
+
+def generate_questions(language, material, difficulty, with_tests=False):
+    return run_sync(agenerate_questions(language, material, difficulty, with_tests))
+
+
+def evaluate_answers(language, questions_with_answers, total=15):
+    return run_sync(aevaluate_answers(language, questions_with_answers, total))
+
+
+def evaluate_result(language, correct_percentage, incorrect_percentage):
+    return run_sync(aevaluate_result(language, correct_percentage, incorrect_percentage))
+
 
 def clean_questions_text(text):
 
@@ -189,6 +348,8 @@ def clean_questions_text(text):
             continue
         if re.match(r"^\*\*.*\*\*$", line.strip()):  # строки вида **...**
             continue
+        if ANSWER_KEY_LINE.match(line) or TESTS_LINE.match(line):  # хранятся отдельно (extract_*)
+            continue
         filtered_lines.append(line)
     cleaned_text = "\n".join(filtered_lines).strip()
 
@@ -217,3 +378,91 @@ def clean_questions_text(text):
     return "\n\n".join(result_blocks)
 
 
+ANSWER_KEY_LINE = re.compile(r"^\W*Ответы\W*:", re.IGNORECASE)
+TESTS_LINE = re.compile(r"^\W*Тесты\W*:", re.IGNORECASE)
+QUESTION_LINE = re.compile(r"^(\d+)\.\s*(.*)")
+OPTION_LINE = re.compile(r"^\s*\(?([A-D])\)\s*")
+
+
+def parse_questions(text, answer_key=None):
+    """
+    Структура вопросов из текста модели (или из clean_questions_text):
+    [{"number": 1, "type": "choice", "stem": ..., "options": ["A) ...", ...], "answer": "A"}, ...].
+    Номер берётся из текста вопроса; пустые строки внутри блоков кода вопрос не разрывают.
+    """
+    answer_key = answer_key or {}
+    items = []
+    in_code = False
+    for line in text.splitlines():
+        stripped = line.strip()
+        if not in_code:
+            if re.match(r"^\s*#+\s*", line) or re.match(r"^\*\*.*\*\*$", stripped):
+                continue
+            if ANSWER_KEY_LINE.match(line) or TESTS_LINE.match(line):
+                continue
+            match = QUESTION_LINE.match(stripped)
+            if match:
+                items.append({"number": int(match.group(1)), "lines": [match.group(2)], "options": []})
+                continue
+            if items and OPTION_LINE.match(line):
+                items[-1]["options"].append(stripped)
+                continue
+        if stripped.startswith("```"):
+            in_code = not in_code
+        if items and not items[-1]["options"]:
+            items[-1]["lines"].append(line)
+
+    questions = []
+    for item in items:
+        is_choice = item["number"] <= 10 and bool(item["options"])
+        lines = item["lines"] if is_choice else item["lines"][:1]
+        questions.append({
+            "number": item["number"],
+            "type": "choice" if is_choice else "practical",
+            # У практических заданий, как и в clean_questions_text, оставляем только формулировку
+            "stem": "\n".join(lines).strip(),
+            "options": item["options"] if is_choice else [],
+            "answer": answer_key.get(str(item["number"])) if is_choice else None
+        })
+    return questions
+
+
+
+def extract_answer_key(text):
+    """Ключ ответов к вопросам 1-10 из строки "Ответы: 1-A, 2-C, ..." в виде {"1": "A", ...}."""
+    answer_key = {}
+    for line in text.splitlines():
+        if ANSWER_KEY_LINE.match(line):
+            for number, letter in re.findall(r"(\d+)\s*[-–:.)]\s*\(?([A-DАВС])\b", line):
+                if 1 <= int(number) <= 10:
+                    # Модель иногда пишет похожие кириллические А, В, С вместо латинских
+                    answer_key[number] = letter.translate(str.maketrans("АВС", "ABC"))
+    return answer_key
+
+
+def selected_option(answer):
+    """Буква выбранного варианта из значения радиокнопки ("B) ...") или None."""
+    match = re.match(r"\s*\(?([A-D])\)", answer or "")
+    return match.group(1) if match else None
+
+
+def extract_practical_tests(text):
+    """Тесты к заданиям 11-15 из строки "Тесты: {...}" в виде {"11": [{"input": ..., "output": ...}], ...}."""
+    for line in text.splitlines():
+        if not TESTS_LINE.match(line):
+            continue
+        try:
+            raw_tests = json.loads(line[line.index("{"):line.rindex("}") + 1])
+        except ValueError:
+            return {}
+        if not isinstance(raw_tests, dict):
+            return {}
+        tests = {}
+        for number, cases in raw_tests.items():
+            if str(number) not in {"11", "12", "13", "14", "15"} or not isinstance(cases, list):
+                continue
+            cases = [case for case in cases if isinstance(case, dict) and "output" in case]
+            if cases:
+                tests[str(number)] = cases
+        return tests
+    return {}
@@ -1,46 +1,119 @@
-from flask import Flask, render_template, redirect, url_for, flash, request, session, jsonify
+from flask import Flask, Blueprint, render_template, redirect, url_for, flash, request, session, jsonify, \
+    Response, stream_with_context, stream_template, current_app
 from flask_sqlalchemy import SQLAlchemy
 from flask_bcrypt import Bcrypt
 import os
 import re
 import json
 import time
+import random
+import asyncio
+import uuid
+import inspect as pyinspect
+import hashlib
+import unicodedata
+import queue
+import threading
+import multiprocessing
+import click
 import markdown
 from dotenv import load_dotenv
-from datetime import timedelta
+from collections import OrderedDict
+from concurrent.futures import ProcessPoolExecutor, wait, FIRST_COMPLETED
+from datetime import datetime, timedelta
 from functools import wraps
-from sqlalchemy import text
+from sqlalchemy import text, or_, and_, event
+from sqlalchemy.exc import IntegrityError
+from sqlalchemy.engine import make_url
+from sqlalchemy.dialects import postgresql, sqlite
 from AI import *
+import sandbox
+import migrations
+import learning_stats
+import blobs
+import metrics
+from singleflight import SingleFlight
 
 # Загрузка переменных окружения
 load_dotenv()
 SECRET_KEY = os.getenv("SECRET_KEY", "default_secret")
 DATABASE_URI = os.getenv("SQLALCHEMY_DATABASE_URI", "sqlite:///site.db")
-
-app = Flask(__name__)
-app.config['SECRET_KEY'] = SECRET_KEY
-app.config['SQLALCHEMY_DATABASE_URI'] = DATABASE_URI
-app.config['SQLALCHEMY_TRACK_MODIFICATIONS'] = False
-app.config['PERMANENT_SESSION_LIFETIME'] = timedelta(days=30)
-
-db = SQLAlchemy(app)
-bcrypt = Bcrypt(app)
-
-@app.template_filter("fromjson")
+# Применять миграции схемы при запуске (иначе — командой `flask db-upgrade`)
+AUTO_MIGRATE = os.getenv("AUTO_MIGRATE", "1") == "1"
+# Общий кэш сгенерированного контента: K вариантов на (язык, день), TTL и общий лимит записей
+CONTENT_CACHE_VARIANTS = int(os.getenv("CONTENT_CACHE_VARIANTS", "3"))
+CONTENT_CACHE_TTL = int(os.getenv("CONTENT_CACHE_TTL", str(30 * 24 * 3600)))
+CONTENT_CACHE_MAX_ENTRIES = int(os.getenv("CONTENT_CACHE_MAX_ENTRIES", "5000"))
+# Фоновая генерация: число потоков-обработчиков (0 — только отдельный `flask generation-worker`),
+# время аренды задачи и максимальное число попыток. Аренда покрывает бюджеты времени материала и вопросов:
+# задачу упавшего процесса другой обработчик подхватит через это время, а не через час
+GENERATION_WORKERS = int(os.getenv("GENERATION_WORKERS", "4"))
+GENERATION_JOB_LEASE = int(os.getenv("GENERATION_JOB_LEASE", str(
+    int(LLM_DEADLINES["generate_material"] + LLM_DEADLINES["generate_questions"]) + 60)))
+GENERATION_JOB_MAX_ATTEMPTS = int(os.getenv("GENERATION_JOB_MAX_ATTEMPTS", "3"))
+GENERATION_POLL_INTERVAL = float(os.getenv("GENERATION_POLL_INTERVAL", "2"))
+# Упреждающая генерация следующего дня (по умолчанию выключена) и лимит одновременных таких задач
+PREFETCH_NEXT_DAY = os.getenv("PREFETCH_NEXT_DAY", "0") == "1"
+PREFETCH_MAX_CONCURRENCY = int(os.getenv("PREFETCH_MAX_CONCURRENCY", "2"))
+PREFETCH_PRIORITY = -10
+# Число отрендеренных Markdown-документов в памяти процесса (перед таблицей rendered_markdown)
+MARKDOWN_CACHE_SIZE = int(os.getenv("MARKDOWN_CACHE_SIZE", "512"))
+# Хранить материал, вопросы и ответы дней сжатыми в общей таблице content_blob (по умолчанию выключено).
+# Уже сжатые записи читаются при любом значении; перенести старые записи — `flask content-compact`
+CONTENT_BLOB_STORAGE = os.getenv("CONTENT_BLOB_STORAGE", "0") == "1"
+# Токен доступа к /metrics (заголовок Authorization: Bearer <токен>); пустой — без проверки
+METRICS_TOKEN = os.getenv("METRICS_TOKEN", "")
+# Дневной лимит токенов GigaChat на пользователя (сутки по UTC); 0 — без ограничения.
+# Сверх лимита контент отдаётся из общего кэша, а генерация откладывается до следующих суток
+LLM_USER_DAILY_TOKENS = int(os.getenv("LLM_USER_DAILY_TOKENS", "0"))
+# Профиль SQLite для параллельной работы: WAL (читатели не блокируют писателя), ожидание
+# освобождения блокировки (мс) вместо ошибки "database is locked" и synchronous=NORMAL
+SQLITE_TUNING = os.getenv("SQLITE_TUNING", "1") == "1"
+SQLITE_BUSY_TIMEOUT = int(os.getenv("SQLITE_BUSY_TIMEOUT", "5000"))
+# Пул соединений: постоянные, дополнительные при пиках, ожидание свободного (с), пересоздание (с)
+DB_POOL_SIZE = int(os.getenv("DB_POOL_SIZE", "10"))
+DB_MAX_OVERFLOW = int(os.getenv("DB_MAX_OVERFLOW", "10"))
+DB_POOL_TIMEOUT = float(os.getenv("DB_POOL_TIMEOUT", "30"))
+DB_POOL_RECYCLE = int(os.getenv("DB_POOL_RECYCLE", "1800"))
+# Аренда ключа однократного выполнения (оценка дня, поток материала) между процессами, с:
+# должна превышать дедлайн вызова модели, иначе ключ перехватят до завершения вызова
+FLIGHT_LEASE = int(os.getenv("FLIGHT_LEASE", "600"))
+FLIGHT_POLL_INTERVAL = float(os.getenv("FLIGHT_POLL_INTERVAL", "1"))
+# Кэш оценок ответов нейросетью (повторная сдача, одинаковые ответы): TTL (с) и лимит записей
+EVALUATION_CACHE_TTL = int(os.getenv("EVALUATION_CACHE_TTL", str(30 * 24 * 3600)))
+EVALUATION_CACHE_MAX_ENTRIES = int(os.getenv("EVALUATION_CACHE_MAX_ENTRIES", "20000"))
+
+db = SQLAlchemy()
+bcrypt = Bcrypt()
+# Маршруты, обработчики запросов и команды CLI; приложение собирает create_app()
+bp = Blueprint("main", __name__, cli_group=None)
+
+
+@bp.app_template_filter("fromjson")
 def fromjson(value):
     try:
         return json.loads(value)
     except (ValueError, TypeError):
         return {}
 
-app.jinja_env.filters["fromjson"] = fromjson
 # Декоратор для защиты маршрутов
 def login_required(f):
+    if pyinspect.iscoroutinefunction(f):
+        # Асинхронные маршруты: Flask должен видеть обёртку как корутину
+        @wraps(f)
+        async def decorated_coroutine(*args, **kwargs):
+            if "user_id" not in session:
+                flash("Пожалуйста, войдите в систему.", "warning")
+                return redirect(url_for("main.login"))
+            return await f(*args, **kwargs)
+
+        return decorated_coroutine
+
     @wraps(f)
     def decorated_function(*args, **kwargs):
         if "user_id" not in session:
             flash("Пожалуйста, войдите в систему.", "warning")
-            return redirect(url_for("login"))
+            return redirect(url_for("main.login"))
         return f(*args, **kwargs)
 
     return decorated_function
@@ -57,18 +130,112 @@ class User(db.Model):
     summaries = db.relationship('Summary', backref='user', lazy=True)
 
 
+# Сжатые тексты контента, одна строка на уникальный текст (SHA-256)
+class ContentBlob(db.Model):
+    __tablename__ = "content_blob"
+    hash = db.Column(db.String(64), primary_key=True)
+    codec = db.Column(db.String(10), nullable=False)
+    data = db.Column(db.LargeBinary, nullable=False)
+    # Размер исходного текста в байтах UTF-8
+    size = db.Column(db.Integer, nullable=False)
+    created_at = db.Column(db.DateTime, default=datetime.utcnow)
+
+
+def insert_ignore(table):
+    """INSERT, пропускающий строку с уже существующим ключом."""
+    dialect = postgresql if db.engine.dialect.name == "postgresql" else sqlite
+    return dialect.insert(table).on_conflict_do_nothing()
+
+
+def store_blob(text):
+    """Сохраняет текст в content_blob (если такого ещё нет) и возвращает его хеш."""
+    content_hash = blobs.content_hash(text)
+    # Без autoflush: запись, которой присваивается текст, может быть ещё не заполнена
+    with db.session.no_autoflush:
+        exists = db.session.query(ContentBlob.hash).filter_by(hash=content_hash).first()
+        if not exists:
+            data, codec = blobs.compress(text)
+            db.session.execute(insert_ignore(ContentBlob.__table__).values(
+                hash=content_hash, codec=codec, data=data,
+                size=len(text.encode("utf-8")), created_at=datetime.utcnow()
+            ))
+    return content_hash
+
+
+def load_blob(content_hash):
+    with db.session.no_autoflush:
+        data, codec = db.session.query(ContentBlob.data, ContentBlob.codec).filter_by(hash=content_hash).one()
+    return blobs.decompress(data, codec)
+
+
+def blob_text(name):
+    """
+    Текстовое поле, которое хранится либо в собственной колонке, либо (CONTENT_BLOB_STORAGE)
+    ссылкой <name>_blob на content_blob. Блоб распаковывается при первом чтении поля.
+    """
+    column_attr, blob_attr = "_" + name, name + "_blob"
+
+    def get(self):
+        content_hash = getattr(self, blob_attr)
+        if content_hash is None:
+            return getattr(self, column_attr)
+        texts = self.__dict__.setdefault("_blob_texts", {})
+        if content_hash not in texts:
+            texts[content_hash] = load_blob(content_hash)
+        return texts[content_hash]
+
+    def set(self, value):
+        if value is None or not CONTENT_BLOB_STORAGE:
+            setattr(self, blob_attr, None)
+            setattr(self, column_attr, value)
+            return
+        content_hash = blobs.content_hash(value)
+        if getattr(self, blob_attr) != content_hash:
+            store_blob(value)
+            setattr(self, blob_attr, content_hash)
+        setattr(self, column_attr, None)
+        self.__dict__.setdefault("_blob_texts", {})[content_hash] = value
+
+    return property(get, set)
+
+
 # Модель дневных данных обучения
 class TrainingData(db.Model):
     id = db.Column(db.Integer, primary_key=True)
     user_id = db.Column(db.Integer, db.ForeignKey('user.id'), nullable=False)
     day = db.Column(db.Integer, nullable=False)
     language = db.Column(db.String(50))
-    material = db.Column(db.Text)
-    questions = db.Column(db.Text)
-    answers = db.Column(db.Text)
-    recommendation = db.Column(db.Text)
+    # Большие текстовые колонки не загружаются вместе со строкой: при первом обращении
+    # к любой из них вся группа "content" догружается одним запросом
+    _material = db.deferred(db.Column("material", db.Text), group="content")
+    _questions = db.deferred(db.Column("questions", db.Text), group="content")
+    _answers = db.deferred(db.Column("answers", db.Text), group="content")
+    # Хеши сжатых текстов в content_blob (CONTENT_BLOB_STORAGE); колонка текста при этом пуста
+    material_blob = db.deferred(db.Column(db.String(64)), group="content")
+    questions_blob = db.deferred(db.Column(db.String(64)), group="content")
+    answers_blob = db.deferred(db.Column(db.String(64)), group="content")
+    material = blob_text("material")
+    questions = blob_text("questions")
+    answers = blob_text("answers")
+    recommendation = db.deferred(db.Column(db.Text), group="content")
     correct_percentage = db.Column(db.Float)
     incorrect_percentage = db.Column(db.Float)
+    # Предварительная оценка: нейросеть не проверила практические задания, оценка будет пересчитана
+    grade_provisional = db.Column(db.Boolean, nullable=False, default=False, server_default="0")
+    # Ключ ответов к вопросам 1-10 в JSON: {"1": "A", ...}
+    answer_key = db.deferred(db.Column(db.Text), group="content")
+    # Тесты к практическим заданиям 11-15 в JSON: {"11": [{"input": ..., "output": ...}], ...}
+    practical_tests = db.deferred(db.Column(db.Text), group="content")
+    # Разобранные вопросы в JSON (AI.parse_questions): номер, тип, формулировка, варианты, ответ
+    question_items = db.deferred(db.Column(db.Text), group="content")
+    # Одна запись на день; индекс обслуживает выборки "последний день по языку".
+    # Частичный индекс предварительных оценок: обработчики ищут их при каждом простое
+    __table_args__ = (
+        db.Index("ix_training_data_user_language_day", "user_id", "language", "day", unique=True),
+        db.Index("ix_training_data_grade_provisional", "id",
+                 sqlite_where=db.column("grade_provisional").is_(True),
+                 postgresql_where=db.column("grade_provisional").is_(True)),
+    )
 
 
 # Модель итоговой сводки
@@ -80,20 +247,1076 @@ class Summary(db.Model):
     overall_incorrect_percentage = db.Column(db.Float)
     language = db.Column(db.String(50))
     day = db.Column(db.Integer)
+    __table_args__ = (db.Index("ix_summary_user_language_day", "user_id", "language", "day"),)
+
+
+# Прогресс пользователя по языку: последний начатый день и его состояние.
+# Обновляется при каждом изменении дней, чтобы панель и маршруты не пересчитывали его по TrainingData
+class Progress(db.Model):
+    id = db.Column(db.Integer, primary_key=True)
+    user_id = db.Column(db.Integer, db.ForeignKey('user.id'), nullable=False)
+    language = db.Column(db.String(50), nullable=False)
+    last_day = db.Column(db.Integer, nullable=False, default=0)
+    last_day_graded = db.Column(db.Boolean, nullable=False, default=False)
+    is_complete = db.Column(db.Boolean, nullable=False, default=False)
+    # Накопительная статистика оценённых дней (learning_stats.py)
+    graded_days = db.Column(db.Integer, nullable=False, default=0, server_default="0")
+    correct_sum = db.Column(db.Float, nullable=False, default=0.0, server_default="0")
+    incorrect_sum = db.Column(db.Float, nullable=False, default=0.0, server_default="0")
+    correct_min = db.Column(db.Float)
+    correct_max = db.Column(db.Float)
+    streak = db.Column(db.Integer, nullable=False, default=0, server_default="0")
+    best_streak = db.Column(db.Integer, nullable=False, default=0, server_default="0")
+    # Число дней в каждом интервале результата, JSON: [0, 0, 1, ...]
+    histogram = db.Column(db.Text)
+    updated_at = db.Column(db.DateTime, default=datetime.utcnow, onupdate=datetime.utcnow)
+    __table_args__ = (db.Index("ix_progress_user_language", "user_id", "language", unique=True),)
+
+
+# HTML, отрендеренный из Markdown, по SHA-256 исходного текста
+class RenderedMarkdown(db.Model):
+    content_hash = db.Column(db.String(64), primary_key=True)
+    html = db.Column(db.Text, nullable=False)
+    created_at = db.Column(db.DateTime, default=datetime.utcnow)
+
+
+# Общий для всех пользователей кэш материала и вопросов по (язык, день, вариант промта)
+class ContentCache(db.Model):
+    id = db.Column(db.Integer, primary_key=True)
+    language = db.Column(db.String(50), nullable=False)
+    day = db.Column(db.Integer, nullable=False)
+    variant = db.Column(db.Integer, nullable=False)
+    material = db.Column(db.Text)
+    questions = db.Column(db.Text)
+    answer_key = db.Column(db.Text)
+    practical_tests = db.Column(db.Text)
+    question_items = db.Column(db.Text)
+    hits = db.Column(db.Integer, default=0)
+    created_at = db.Column(db.DateTime, default=datetime.utcnow)
+    last_used_at = db.Column(db.DateTime, default=datetime.utcnow)
+    __table_args__ = (db.UniqueConstraint("language", "day", "variant"),)
+
+
+# Задача фоновой генерации материала и вопросов для дня обучения
+class GenerationJob(db.Model):
+    id = db.Column(db.String(32), primary_key=True, default=lambda: uuid.uuid4().hex)
+    user_id = db.Column(db.Integer, db.ForeignKey('user.id'), nullable=False)
+    language = db.Column(db.String(50), nullable=False)
+    day = db.Column(db.Integer, nullable=False)
+    # Вариант промта; задаётся, если материал уже получен потоком и нужны только вопросы
+    variant = db.Column(db.Integer)
+    priority = db.Column(db.Integer, default=0)
+    # queued -> running -> done | failed
+    status = db.Column(db.String(20), default="queued", nullable=False)
+    attempts = db.Column(db.Integer, default=0, nullable=False)
+    lease_until = db.Column(db.DateTime)
+    # "user_id:language:day" у действующей (не failed) задачи: уникальность не даёт параллельным
+    # запросам и процессам поставить вторую задачу для того же дня
+    dedup_key = db.Column(db.String(120))
+    material = db.Column(db.Text)
+    questions = db.Column(db.Text)
+    answer_key = db.Column(db.Text)
+    practical_tests = db.Column(db.Text)
+    question_items = db.Column(db.Text)
+    error = db.Column(db.Text)
+    created_at = db.Column(db.DateTime, default=datetime.utcnow)
+    started_at = db.Column(db.DateTime)
+    finished_at = db.Column(db.DateTime)
+    __table_args__ = (
+        db.Index("ix_generation_job_user_language_day", "user_id", "language", "day"),
+        db.Index("ix_generation_job_status_priority", "status", "priority"),
+        db.Index("ix_generation_job_dedup_key", "dedup_key", unique=True),
+    )
+
+
+# Израсходованные токены GigaChat за сутки по (пользователь, язык, функция AI.py).
+# user_id = 0 — вызовы вне запроса пользователя
+class TokenUsage(db.Model):
+    id = db.Column(db.Integer, primary_key=True)
+    user_id = db.Column(db.Integer, nullable=False)
+    language = db.Column(db.String(50), nullable=False, default="")
+    function = db.Column(db.String(50), nullable=False)
+    date = db.Column(db.Date, nullable=False)
+    calls = db.Column(db.Integer, nullable=False, default=0)
+    prompt_tokens = db.Column(db.Integer, nullable=False, default=0)
+    completion_tokens = db.Column(db.Integer, nullable=False, default=0)
+    __table_args__ = (db.Index("ix_token_usage_key", "user_id", "language", "function", "date", unique=True),)
+
+
+# Ответы evaluate_answers по хешу языка, числа вопросов и нормализованного текста ответов
+class EvaluationCache(db.Model):
+    key = db.Column(db.String(64), primary_key=True)
+    response = db.Column(db.Text, nullable=False)
+    hits = db.Column(db.Integer, default=0)
+    created_at = db.Column(db.DateTime, default=datetime.utcnow)
+    last_used_at = db.Column(db.DateTime, default=datetime.utcnow)
+    __table_args__ = (db.Index("ix_evaluation_cache_last_used_at", "last_used_at"),)
+
+
+# Аренда ключа однократного выполнения: пока она действует, другие процессы не повторяют
+# ту же работу, а ждут её результат в базе
+class FlightLease(db.Model):
+    key = db.Column(db.String(200), primary_key=True)
+    owner = db.Column(db.String(32), nullable=False)
+    expires_at = db.Column(db.DateTime, nullable=False)
+
+
+def create_app(config=None):
+    """
+    Фабрика приложения. Импорт модуля и создание приложения не обращаются к GigaChat:
+    клиент создаётся при первом вызове модели (AI.get_giga). Схема базы обновляется здесь
+    только при AUTO_MIGRATE=1; в развёртывании с несколькими процессами — один раз `flask db-upgrade`.
+    """
+    app = Flask(__name__)
+    app.config['SECRET_KEY'] = SECRET_KEY
+    app.config['SQLALCHEMY_DATABASE_URI'] = DATABASE_URI
+    app.config['SQLALCHEMY_TRACK_MODIFICATIONS'] = False
+    app.config['PERMANENT_SESSION_LIFETIME'] = timedelta(days=30)
+    if config:
+        app.config.update(config)
+    app.config.setdefault("SQLALCHEMY_ENGINE_OPTIONS", engine_options(app.config["SQLALCHEMY_DATABASE_URI"]))
+
+    db.init_app(app)
+    bcrypt.init_app(app)
+    app.register_blueprint(bp)
+
+    with app.app_context():
+        if SQLITE_TUNING and db.engine.dialect.name == "sqlite":
+            event.listen(db.engine, "connect", tune_sqlite_connection)
+        if AUTO_MIGRATE:
+            migrations.upgrade(db)
+        event.listen(db.engine, "before_cursor_execute", metrics.before_query)
+        event.listen(db.engine, "after_cursor_execute", metrics.after_query)
+    # Расход токенов записывается в базу последнего созданного приложения (слушатель один на процесс)
+    global _token_usage_app
+    _token_usage_app = app
+    return app
+
+
+def engine_options(uri):
+    """Параметры пула соединений; SQLite в памяти работает с одним соединением и пул не настраивается."""
+    url = make_url(uri)
+    if url.get_backend_name() == "sqlite" and url.database in (None, "", ":memory:"):
+        return {}
+    options = {"pool_size": DB_POOL_SIZE, "max_overflow": DB_MAX_OVERFLOW, "pool_timeout": DB_POOL_TIMEOUT}
+    if url.get_backend_name() != "sqlite":
+        # Серверные БД закрывают простаивающие соединения
+        options.update(pool_recycle=DB_POOL_RECYCLE, pool_pre_ping=True)
+    return options
+
+
+def tune_sqlite_connection(dbapi_connection, connection_record):
+    cursor = dbapi_connection.cursor()
+    cursor.execute("PRAGMA journal_mode=WAL")
+    cursor.execute(f"PRAGMA busy_timeout={SQLITE_BUSY_TIMEOUT}")
+    cursor.execute("PRAGMA synchronous=NORMAL")
+    cursor.close()
+
+
+def release_db_connection():
+    """
+    Завершает транзакцию сессии и возвращает соединение в пул перед долгим вызовом модели или песочницы.
+    Загруженные атрибуты объектов остаются доступны для чтения; запись после вызова идёт в новой
+    транзакции и должна проверять, что данные не изменились за это время.
+    """
+    db.session.close()
+
+
+def acquire_lease(key, ttl=FLIGHT_LEASE):
+    """Захватывает аренду ключа (свободного или с истёкшим сроком); возвращает владельца или None."""
+    owner = uuid.uuid4().hex
+    now = datetime.utcnow()
+    table = FlightLease.__table__
+    with db.engine.begin() as connection:
+        taken = connection.execute(insert_ignore(table).values(
+            key=key, owner=owner, expires_at=now + timedelta(seconds=ttl))).rowcount
+        if not taken:
+            taken = connection.execute(table.update().where(table.c.key == key, table.c.expires_at < now).values(
+                owner=owner, expires_at=now + timedelta(seconds=ttl))).rowcount
+    return owner if taken else None
+
+
+def release_lease(key, owner):
+    table = FlightLease.__table__
+    with db.engine.begin() as connection:
+        connection.execute(table.delete().where(table.c.key == key, table.c.owner == owner))
+
+
+def lease_active(key):
+    table = FlightLease.__table__
+    with db.engine.begin() as connection:
+        return connection.execute(db.select(table.c.key).where(
+            table.c.key == key, table.c.expires_at >= datetime.utcnow())).first() is not None
+
+
+# Одновременные оценки одних и тех же ответов в этом процессе
+grading_flights = SingleFlight()
+
+
+# Метрики вызовов модели (metrics.py, /metrics); SQL-запросы учитываются слушателями движка из create_app
+llm.listeners.append(metrics.observe_llm_call)
+
+
+# Слушатель вызывается в потоке цикла AI и не должен ждать блокировок базы: итоги вызовов
+# передаются через очередь одному потоку записи (в каждом процессе, в т.ч. после fork)
+_token_usage_app = None
+_token_usage_queue = queue.Queue()
+_token_usage_lock = threading.Lock()
+_token_usage_writer_pid = None
+
+
+def queue_token_usage(stats):
+    """Слушатель LLMClient: передаёт итог вызова с токенами потоку записи."""
+    app = _token_usage_app
+    if app is None or not (stats.prompt_tokens or stats.completion_tokens):
+        return
+    ensure_token_usage_writer()
+    _token_usage_queue.put((app, stats))
+
+
+def ensure_token_usage_writer():
+    global _token_usage_queue, _token_usage_writer_pid
+    if _token_usage_writer_pid == os.getpid():
+        return
+    with _token_usage_lock:
+        if _token_usage_writer_pid == os.getpid():
+            return
+        # Очередь, унаследованную при fork, обрабатывает родительский процесс
+        _token_usage_queue = queue.Queue()
+        threading.Thread(target=_token_usage_writer_loop, args=(_token_usage_queue,), daemon=True).start()
+        _token_usage_writer_pid = os.getpid()
+
+
+def _token_usage_writer_loop(usage_queue):
+    while True:
+        app, stats = usage_queue.get()
+        try:
+            record_token_usage(app, stats)
+        finally:
+            usage_queue.task_done()
+
+
+def flush_token_usage():
+    """Ждёт записи всех итогов из очереди (перед завершением команды)."""
+    if _token_usage_writer_pid == os.getpid():
+        _token_usage_queue.join()
+
+
+llm.listeners.append(queue_token_usage)
+
+
+def record_token_usage(app, stats):
+    """
+    Добавляет токены вызова к дневному счётчику пользователя. Выполняется в потоке записи
+    (queue_token_usage), поэтому пишет отдельным соединением, а не через db.session.
+    """
+    key = {
+        "user_id": stats.tags.get("user_id") or 0,
+        "language": stats.tags.get("language") or "",
+        "function": stats.name,
+        "date": datetime.utcnow().date(),
+    }
+    table = TokenUsage.__table__
+    condition = and_(*(table.c[column] == value for column, value in key.items()))
+    with app.app_context():
+        # Два потока могут одновременно создавать строку дня: проигравший повторяет UPDATE
+        for _ in range(2):
+            try:
+                with db.engine.begin() as connection:
+                    updated = connection.execute(table.update().where(condition).values(
+                        calls=table.c.calls + 1,
+                        prompt_tokens=table.c.prompt_tokens + stats.prompt_tokens,
+                        completion_tokens=table.c.completion_tokens + stats.completion_tokens,
+                    )).rowcount
+                    if not updated:
+                        connection.execute(table.insert().values(
+                            calls=1, prompt_tokens=stats.prompt_tokens,
+                            completion_tokens=stats.completion_tokens, **key))
+                return
+            except IntegrityError:
+                continue
+            except Exception as e:
+                print(f"Не удалось записать расход токенов: {e}")
+                return
+
+
+
+def tokens_used_today(user_id):
+    total = db.session.query(db.func.sum(TokenUsage.prompt_tokens + TokenUsage.completion_tokens)).filter(
+        TokenUsage.user_id == user_id, TokenUsage.date == datetime.utcnow().date()
+    ).scalar()
+    return total or 0
+
+
+def over_token_budget(user_id):
+    """Исчерпал ли пользователь дневной лимит LLM_USER_DAILY_TOKENS."""
+    return bool(LLM_USER_DAILY_TOKENS and user_id) and tokens_used_today(user_id) >= LLM_USER_DAILY_TOKENS
+
+
+def token_budget_reset():
+    """Начало следующих суток по UTC — момент обновления дневного лимита."""
+    return datetime.combine(datetime.utcnow().date() + timedelta(days=1), datetime.min.time())
+
+
+class TokenBudgetExceeded(Exception):
+    pass
+
+
+@bp.before_app_request
+def set_llm_call_tags():
+    # Вызовы модели из этого запроса учитываются на пользователя и выбранный язык
+    call_tags.set({"user_id": session.get("user_id"), "language": session.get("selected_language")})
+
+
+@bp.before_app_request
+def start_request_metrics():
+    metrics.start_request(request.endpoint or "unknown")
+
+
+@bp.after_app_request
+def finish_request_metrics(response):
+    tracker = metrics.current_request.get()
+    method, status = request.method, response.status_code
+    if response.is_streamed:
+        # Потоковый ответ формируется после выхода из представления: считаем до его отдачи
+        response.call_on_close(lambda: metrics.finish_request(tracker, method, status))
+    else:
+        metrics.finish_request(tracker, method, status)
+        metrics.current_request.set(None)
+    return response
+
+
+@bp.teardown_app_request
+def fail_request_metrics(error):
+    # after_request не вызывается при необработанном исключении
+    if error is not None:
+        metrics.finish_request(metrics.current_request.get(), request.method, 500)
+        metrics.current_request.set(None)
+
+
+def metrics_authorized():
+    return not METRICS_TOKEN or request.headers.get("Authorization") == f"Bearer {METRICS_TOKEN}"
+
+
+@bp.route("/metrics")
+def metrics_endpoint():
+    if not metrics_authorized():
+        return Response("Forbidden\n", status=403, mimetype="text/plain")
+    return Response(metrics.render(), mimetype="text/plain; version=0.0.4; charset=utf-8")
+
+
+@bp.route("/metrics/traces")
+def metrics_traces():
+    """Последние трассировки (при TRACING=1) в JSON."""
+    if not metrics_authorized():
+        return jsonify({"error": "Forbidden"}), 403
+    return jsonify([trace.as_dict() for trace in list(metrics.traces)])
+
+
+@bp.cli.command("db-upgrade")
+def db_upgrade_command():
+    """Применяет миграции схемы базы данных."""
+    applied = migrations.upgrade(db)
+    print(f"Применено миграций: {len(applied)}" if applied else "Схема базы данных актуальна")
+
+
+@bp.cli.command("content-compact")
+def content_compact_command():
+    """
+    Переносит материал, вопросы и ответы дней в content_blob (нужен CONTENT_BLOB_STORAGE=1)
+    и удаляет блобы, на которые больше не ссылается ни одна запись.
+    """
+    if not CONTENT_BLOB_STORAGE:
+        print("Включите CONTENT_BLOB_STORAGE=1, чтобы переносить тексты в content_blob")
+    else:
+        moved = 0
+        while True:
+            batch = TrainingData.query.filter(or_(
+                TrainingData._material.isnot(None),
+                TrainingData._questions.isnot(None),
+                TrainingData._answers.isnot(None)
+            )).order_by(TrainingData.id).limit(200).all()
+            if not batch:
+                break
+            for record in batch:
+                # Присваивание через свойство сохраняет текст в content_blob и очищает колонку
+                for field in ("material", "questions", "answers"):
+                    setattr(record, field, getattr(record, field))
+            db.session.commit()
+            moved += len(batch)
+        print(f"Перенесено записей: {moved}")
+
+    referenced = " UNION ".join(
+        f"SELECT {column} FROM training_data WHERE {column} IS NOT NULL"
+        for column in ("material_blob", "questions_blob", "answers_blob")
+    )
+    removed = db.session.execute(text(f"DELETE FROM content_blob WHERE hash NOT IN ({referenced})")).rowcount
+    db.session.commit()
+    print(f"Удалено неиспользуемых блобов: {removed}")
+    stored = db.session.query(db.func.count(ContentBlob.hash), db.func.sum(ContentBlob.size),
+                              db.func.sum(db.func.length(ContentBlob.data))).one()
+    if stored[0]:
+        print(f"Блобов: {stored[0]}, исходный размер {stored[1]} байт, сжатый {stored[2]} байт")
+        if db.engine.dialect.name == "sqlite":
+            print("Чтобы вернуть освободившееся место в файл базы, выполните VACUUM")
+
+
+@bp.cli.command("db-status")
+def db_status_command():
+    """Показывает применённые и ожидающие миграции."""
+    for version, name, applied in migrations.status(db):
+        print(f"{version:>3} {'+' if applied else ' '} {name}")
+
+
+_markdown_cache = OrderedDict()
+_markdown_cache_lock = threading.Lock()
+
+
+def render_markdown(source):
+    """
+    HTML для Markdown-текста. Рендерится один раз на содержимое: сначала ищется в LRU
+    процесса, затем в таблице rendered_markdown по хешу текста.
+    """
+    content_hash = hashlib.sha256(source.encode("utf-8")).hexdigest()
+    with _markdown_cache_lock:
+        html = _markdown_cache.get(content_hash)
+        if html is not None:
+            _markdown_cache.move_to_end(content_hash)
+            return html
+
+    stored = db.session.get(RenderedMarkdown, content_hash)
+    if stored:
+        html = stored.html
+    else:
+        html = markdown.markdown(source)
+        # Отдельная транзакция, чтобы не затрагивать изменения текущей сессии
+        try:
+            with db.engine.begin() as connection:
+                connection.execute(RenderedMarkdown.__table__.insert().values(
+                    content_hash=content_hash, html=html, created_at=datetime.utcnow()
+                ))
+        except IntegrityError:
+            pass  # тот же текст уже отрендерил параллельный запрос
+
+    with _markdown_cache_lock:
+        _markdown_cache[content_hash] = html
+        while len(_markdown_cache) > MARKDOWN_CACHE_SIZE:
+            _markdown_cache.popitem(last=False)
+    return html
+
+
+# Поля сгенерированного контента дня; одноимённые колонки есть в TrainingData, ContentCache и GenerationJob
+CONTENT_FIELDS = ("material", "questions", "answer_key", "practical_tests", "question_items")
+
+
+def content_of(record):
+    """Контент дня из записи любой из моделей в виде словаря."""
+    return {field: getattr(record, field) for field in CONTENT_FIELDS}
+
+
+def question_items_of(content):
+    """
+    Структура вопросов дня. Для записей, созданных до появления question_items,
+    разбирается из сохранённого текста вопросов.
+    """
+    if content.get("question_items"):
+        return json.loads(content["question_items"])
+    answer_key = json.loads(content["answer_key"]) if content.get("answer_key") else {}
+    return parse_questions(content.get("questions") or "", answer_key)
+
+
+def content_response(day, content, **extra):
+    """JSON-ответ с материалом и вопросами (ключ ответов клиенту не отдаём)."""
+    items = [{key: value for key, value in item.items() if key != "answer"} for item in question_items_of(content)]
+    payload = {"day": day, "material": content["material"], "questions": content["questions"], "items": items}
+    payload.update(extra)
+    return jsonify(payload)
+
+
+def get_cached_content(language, day, min_variants=CONTENT_CACHE_VARIANTS):
+    """
+    Возвращает вариант контента из общего кэша или None, если пул вариантов
+    для (language, day) ещё не заполнен до min_variants (по умолчанию CONTENT_CACHE_VARIANTS).
+    """
+    now = datetime.utcnow()
+    # Устаревшие по TTL варианты удаляем сразу, чтобы пул пополнился свежими
+    ContentCache.query.filter(
+        ContentCache.language == language,
+        ContentCache.day == day,
+        ContentCache.created_at < now - timedelta(seconds=CONTENT_CACHE_TTL)
+    ).delete(synchronize_session=False)
+    entries = ContentCache.query.filter_by(language=language, day=day).all()
+    if not entries or len(entries) < min_variants:
+        db.session.commit()
+        return None
+
+    entry = random.choice(entries)
+    entry.hits = (entry.hits or 0) + 1
+    entry.last_used_at = now
+    db.session.commit()
+    return entry
+
+
+def store_cached_content(language, day, variant, content):
+    """Сохраняет вариант в общий кэш и вытесняет давно не использованные записи (LRU)."""
+    entry = ContentCache(language=language, day=day, variant=variant, **content)
+    db.session.add(entry)
+    try:
+        db.session.commit()
+    except IntegrityError:
+        # Этот вариант уже сохранил параллельный запрос
+        db.session.rollback()
+        return ContentCache.query.filter_by(language=language, day=day, variant=variant).first()
+
+    overflow = ContentCache.query.count() - CONTENT_CACHE_MAX_ENTRIES
+    if overflow > 0:
+        stale_ids = [row.id for row in ContentCache.query.with_entities(ContentCache.id)
+                     .order_by(ContentCache.last_used_at.asc()).limit(overflow)]
+        ContentCache.query.filter(ContentCache.id.in_(stale_ids)).delete(synchronize_session=False)
+        db.session.commit()
+    return entry
+
+
+def build_content(language, day, variant, material=None):
+    """Генерирует контент дня (см. CONTENT_FIELDS) через GigaChat; к базе не обращается."""
+    if material is None:
+        with metrics.span("generate_material", language=language, day=day, variant=variant):
+            material = generate_material(language, day, variant)
+        if is_generation_error(material):
+            # Материала нет (бюджет времени исчерпан, предохранитель разомкнут): вопросы к тексту ошибки
+            # не запрашиваем, чтобы вызывающий код сразу перешёл к запасному варианту
+            return dict(dict.fromkeys(CONTENT_FIELDS), material=material)
+        material = re.sub(r"^День\s*\d+\s*:\s*", "", material, flags=re.IGNORECASE)
+    with metrics.span("generate_questions", language=language, day=day):
+        raw_questions = generate_questions(language, material, day, with_tests=sandbox.supports(language))
+    generated = not is_generation_error(raw_questions)
+    answer_key = extract_answer_key(raw_questions) if generated else {}
+    return {
+        "material": material,
+        "questions": clean_questions_text(raw_questions),
+        "answer_key": json.dumps(answer_key) if generated else None,
+        "practical_tests": json.dumps(extract_practical_tests(raw_questions), ensure_ascii=False) if generated else None,
+        # Вопросы разбираются один раз здесь, а не при каждом показе и отправке ответов
+        "question_items": json.dumps(parse_questions(raw_questions, answer_key), ensure_ascii=False) if generated else None
+    }
+
+
+@metrics.traced("generate_content")
+def generate_content(language, day, material=None, variant=None):
+    """
+    Возвращает контент дня (см. CONTENT_FIELDS): из общего кэша, а при промахе
+    генерирует новый вариант через GigaChat и добавляет его в пул.
+    Если material уже получен (потоковая генерация), создаются только вопросы.
+    """
+    if material is None:
+        cached = get_cached_content(language, day)
+        if cached:
+            return content_of(cached)
+
+    used_variants = cached_variants(language, day)
+    if variant is None:
+        variant = pick_content_variant(language, day, used_variants)
+    # Генерация занимает минуты: соединение на это время не держим, кэш пополняется в новой транзакции
+    release_db_connection()
+    content = build_content(language, day, variant, material)
+
+    # Ошибки генерации не кэшируем, чтобы не раздавать их другим пользователям
+    if not content_error(content) and variant not in used_variants:
+        store_cached_content(language, day, variant, content)
+    return content
+
+
+def content_error(content):
+    """Текст ошибки генерации, если она есть в контенте, иначе None."""
+    for field in ("material", "questions"):
+        if is_generation_error(content[field]):
+            return content[field] or "Пустой ответ модели"
+    return None
+
+
+def cached_variants(language, day):
+    """Номера вариантов промта, уже сохранённых в пуле кэша для (language, day)."""
+    return {row.variant for row in ContentCache.query.with_entities(ContentCache.variant)
+            .filter_by(language=language, day=day)}
+
+
+def pick_content_variant(language, day, used_variants=None):
+    """Выбирает вариант промта, которого ещё нет в пуле кэша для (language, day)."""
+    if used_variants is None:
+        used_variants = cached_variants(language, day)
+    free_variants = [v for v in range(MATERIAL_PROMPT_VARIANTS) if v not in used_variants]
+    return random.choice(free_variants or range(MATERIAL_PROMPT_VARIANTS))
+
+
+def get_progress(user_id, language):
+    return Progress.query.filter_by(user_id=user_id, language=language).first()
+
+
+def record_progress(user_id, language, day, graded):
+    """
+    Отмечает изменение дня (создан, оценён, сброшен для пересдачи) в Progress.
+    Коммит выполняет вызывающий код вместе с изменением TrainingData.
+    """
+    progress = get_progress(user_id, language)
+    if not progress:
+        progress = Progress(user_id=user_id, language=language, last_day=day, last_day_graded=graded)
+        db.session.add(progress)
+    elif day > progress.last_day:
+        progress.last_day = day
+        progress.last_day_graded = graded
+    elif day == progress.last_day:
+        progress.last_day_graded = graded
+    progress.is_complete = progress.last_day >= 30 and progress.last_day_graded
+    return progress
 
 
-with app.app_context():
-    db.create_all()
+def stats_of(progress):
+    stats = {field: getattr(progress, field) for field in learning_stats.STAT_FIELDS}
+    stats["histogram"] = json.loads(progress.histogram) if progress.histogram else learning_stats.empty()["histogram"]
+    return stats
+
+
+def store_stats(progress, stats):
+    for field in learning_stats.STAT_FIELDS:
+        setattr(progress, field, stats[field])
+    progress.histogram = json.dumps(stats["histogram"])
+
+
+def record_grade(progress, correct, incorrect):
+    """Добавляет результат оценённого дня в статистику Progress. Коммит — за вызывающим кодом."""
+    store_stats(progress, learning_stats.add_result(stats_of(progress), correct, incorrect))
+
+
+def rebuild_learning_stats(progress):
+    """Пересчитывает статистику по записям дней — после сброса оценки, когда вычесть результат нельзя."""
+    results = db.session.query(TrainingData.correct_percentage, TrainingData.incorrect_percentage).filter(
+        TrainingData.user_id == progress.user_id,
+        TrainingData.language == progress.language,
+        TrainingData.correct_percentage.isnot(None)
+    ).order_by(TrainingData.day.asc()).all()
+    # В старых записях вместо процента может быть пустая строка — такой день не оценён
+    results = [(correct, incorrect) for correct, incorrect in results if correct not in [None, ""]]
+    store_stats(progress, learning_stats.compute(results))
+
+
+def learning_stats_view(progress):
+    """Статистика курса для страниц и итогов: средние, минимум, максимум, серии, гистограмма."""
+    stats = stats_of(progress) if progress else learning_stats.empty()
+    correct_avg, incorrect_avg = learning_stats.averages(stats)
+    return dict(stats, correct_avg=correct_avg, incorrect_avg=incorrect_avg)
+
+
+def get_learning_stats(user_id, language=None):
+    """
+    Статистика одного языка или, без language, словарь {язык: статистика} по всем языкам
+    пользователя — одним запросом к Progress.
+    """
+    if language is not None:
+        return learning_stats_view(get_progress(user_id, language))
+    return {progress.language: learning_stats_view(progress)
+            for progress in Progress.query.filter_by(user_id=user_id).all()}
+
+
+def get_latest_training(user_id, language):
+    """Запись последнего начатого дня: поиск по уникальному индексу (user_id, language, day)."""
+    progress = get_progress(user_id, language)
+    if not progress:
+        return None
+    return TrainingData.query.filter_by(user_id=user_id, language=language, day=progress.last_day).first()
+
+
+def get_current_day(user_id, language):
+    """Текущий день обучения: следующий после оценённого, иначе последний начатый."""
+    progress = get_progress(user_id, language)
+
+    # Если записей нет или найден только день 0, начинаем с 1
+    if not progress or progress.last_day == 0:
+        return 1
+    # Если последний день завершён (есть correct_percentage), переходим к следующему дню
+    if progress.last_day_graded:
+        return progress.last_day + 1
+    return progress.last_day
+
+
+def save_training_content(user_id, language, day, content):
+    """Записывает контент дня в TrainingData пользователя, если его там ещё нет."""
+    record = TrainingData.query.filter_by(user_id=user_id, language=language, day=day).first()
+    if record:
+        if not (record.material and record.questions):
+            for field, value in content.items():
+                setattr(record, field, value)
+    else:
+        record = TrainingData(
+            user_id=user_id,
+            day=day,
+            language=language,
+            answers=None,
+            correct_percentage=None,
+            incorrect_percentage=None,
+            recommendation=None,
+            **content
+        )
+        db.session.add(record)
+    record_progress(user_id, language, day, record.correct_percentage is not None)
+    try:
+        db.session.commit()
+    except IntegrityError:
+        # Запись этого дня только что создал параллельный запрос
+        db.session.rollback()
+        return save_training_content(user_id, language, day, content)
+    # HTML для истории (/daysdata) готовим сразу при записи
+    if record.material:
+        render_markdown(record.material)
+    return record
+
+
+def enqueue_generation_job(user_id, language, day, priority=0, material=None, variant=None):
+    """Ставит задачу генерации в очередь или возвращает уже существующую для этого дня."""
+    dedup_key = f"{user_id}:{language}:{day}"
+    job = GenerationJob.query.filter_by(dedup_key=dedup_key).first()
+    if job:
+        # Пользователь пришёл за днём, который ещё ждёт в очереди упреждающей генерации
+        if job.status == "queued" and (job.priority or 0) < priority:
+            job.priority = priority
+            db.session.commit()
+        return job
+
+    job = GenerationJob(user_id=user_id, language=language, day=day, priority=priority,
+                        material=material, variant=variant, dedup_key=dedup_key)
+    db.session.add(job)
+    try:
+        db.session.commit()
+    except IntegrityError:
+        # Задачу для этого дня только что поставил параллельный запрос (или процесс): присоединяемся к ней
+        db.session.rollback()
+        return enqueue_generation_job(user_id, language, day, priority, material, variant)
+    ensure_generation_workers()
+    _generation_wakeup.set()
+    return job
+
+
+def prefetch_next_day(user_id, language, day):
+    """Ставит в очередь генерацию дня day + 1 с низким приоритетом, если включён PREFETCH_NEXT_DAY."""
+    next_day = day + 1
+    if not PREFETCH_NEXT_DAY or not language or next_day > 30:
+        return None
+    existing = TrainingData.query.filter_by(user_id=user_id, language=language, day=next_day).first()
+    if existing and existing.material and existing.questions:
+        return None
+    return enqueue_generation_job(user_id, language, next_day, priority=PREFETCH_PRIORITY)
+
+
+def claim_generation_job():
+    """
+    Атомарно захватывает следующую задачу. Задачи "running" с истёкшей арендой
+    (процесс упал или был перезапущен) захватываются повторно.
+    Возвращает (job_id, attempts) или None.
+    """
+    now = datetime.utcnow()
+    # У отложенных задач (пользователь исчерпал лимит токенов) lease_until — время повторной попытки
+    query = GenerationJob.query.filter(or_(
+        and_(GenerationJob.status == "queued",
+             or_(GenerationJob.lease_until.is_(None), GenerationJob.lease_until <= now)),
+        and_(GenerationJob.status == "running", GenerationJob.lease_until < now)
+    ))
+    # Упреждающие задачи не занимают больше PREFETCH_MAX_CONCURRENCY обработчиков
+    running_prefetch = GenerationJob.query.filter(
+        GenerationJob.status == "running",
+        GenerationJob.lease_until >= now,
+        GenerationJob.priority <= PREFETCH_PRIORITY
+    ).count()
+    if running_prefetch >= PREFETCH_MAX_CONCURRENCY:
+        query = query.filter(GenerationJob.priority > PREFETCH_PRIORITY)
+    candidates = query.order_by(GenerationJob.priority.desc(), GenerationJob.created_at.asc()).limit(10).all()
+
+    for job in candidates:
+        if job.attempts >= GENERATION_JOB_MAX_ATTEMPTS:
+            job.status = "failed"
+            job.dedup_key = None
+            job.error = job.error or "Превышено число попыток генерации"
+            job.finished_at = now
+            db.session.commit()
+            continue
+        job_id, attempts = job.id, job.attempts + 1
+        # Условие по attempts гарантирует, что задачу захватит только один обработчик
+        claimed = GenerationJob.query.filter(
+            GenerationJob.id == job_id,
+            GenerationJob.status == job.status,
+            GenerationJob.attempts == job.attempts
+        ).update({
+            "status": "running",
+            "attempts": attempts,
+            "lease_until": now + timedelta(seconds=GENERATION_JOB_LEASE),
+            "started_at": now
+        }, synchronize_session=False)
+        db.session.commit()
+        if claimed:
+            return job_id, attempts
+    return None
+
+
+@metrics.traced("generation_job")
+def run_generation_job(job_id, attempts):
+    job = db.session.get(GenerationJob, job_id)
+    if job is None:
+        # Задачу удалил /reset_training между захватом и запуском
+        return
+    if over_token_budget(job.user_id):
+        # Сверх лимита отдаём любой вариант из кэша, а если его нет — откладываем задачу до новых суток
+        cached = get_cached_content(job.language, job.day, min_variants=1) if job.material is None else None
+        if not cached:
+            defer_generation_job(job_id, attempts)
+            return
+        content, error = content_of(cached), None
+    else:
+        # generate_content освобождает соединение, после чего job отсоединён от сессии
+        language, day, material = job.language, job.day, job.material
+        tags = call_tags.set({"user_id": job.user_id, "language": language})
+        try:
+            content = generate_content(language, day, material, job.variant)
+            error = content_error(content)
+        except Exception as e:
+            db.session.rollback()
+            error = f"Ошибка при генерации обучающего материала: {e}"
+        finally:
+            call_tags.reset(tags)
+        if error and material is None:
+            # Ни основная, ни запасная модель не ответили в бюджет времени: отдаём любой готовый вариант
+            cached = get_cached_content(language, day, min_variants=1)
+            if cached:
+                print(f"Задача генерации {job_id}: {error}; выдан вариант из кэша")
+                content, error = content_of(cached), None
+
+    if error:
+        # Неудачная задача освобождает ключ дня: следующий запрос поставит новую
+        update = {"status": "failed", "error": error, "dedup_key": None}
+    else:
+        update = dict(content, status="done")
+    update["finished_at"] = datetime.utcnow()
+    # Результат записываем, только если задачу не перехватил другой обработчик
+    GenerationJob.query.filter_by(id=job_id, status="running", attempts=attempts)\
+        .update(update, synchronize_session=False)
+    db.session.commit()
+
+
+def defer_generation_job(job_id, attempts):
+    """Возвращает задачу в очередь до обновления дневного лимита токенов; попытка не засчитывается."""
+    GenerationJob.query.filter_by(id=job_id, status="running", attempts=attempts).update({
+        "status": "queued",
+        "attempts": attempts - 1,
+        "lease_until": token_budget_reset(),
+        "error": "Дневной лимит запросов к нейросети исчерпан: материал будет подготовлен после обновления лимита",
+    }, synchronize_session=False)
+    db.session.commit()
+
+
+_generation_wakeup = threading.Event()
+_generation_workers_lock = threading.Lock()
+_generation_workers_pid = None
+
+
+def _generation_worker_loop(app):
+    while True:
+        with app.app_context():
+            try:
+                claimed = claim_generation_job()
+                if claimed:
+                    run_generation_job(*claimed)
+                else:
+                    claimed = regrade_provisional_day()
+            except Exception as e:
+                # Ошибка базы (например, "database is locked") не должна останавливать обработчик:
+                # незавершённую задачу после окончания аренды захватит повторно любой обработчик
+                db.session.rollback()
+                print(f"Ошибка обработчика генерации: {e}")
+                claimed = None
+            finally:
+                db.session.remove()
+        if not claimed:
+            _generation_wakeup.wait(GENERATION_POLL_INTERVAL)
+            _generation_wakeup.clear()
+
+
+def ensure_generation_workers(count=None):
+    """Запускает потоки-обработчики в текущем процессе (один раз на процесс, в т.ч. после fork)."""
+    global _generation_workers_pid
+    count = GENERATION_WORKERS if count is None else count
+    if count <= 0 or _generation_workers_pid == os.getpid():
+        return
+    with _generation_workers_lock:
+        if _generation_workers_pid == os.getpid():
+            return
+        for _ in range(count):
+            threading.Thread(target=_generation_worker_loop, args=(current_app._get_current_object(),),
+                             daemon=True).start()
+        _generation_workers_pid = os.getpid()
+
+
+@bp.cli.command("generation-worker")
+def generation_worker_command():
+    """Отдельный процесс-обработчик очереди генерации."""
+    ensure_generation_workers(max(GENERATION_WORKERS, 1))
+    while True:
+        time.sleep(60)
+
+
+# Токенов на вызов для оценки `flask pregenerate --dry-run`, пока в token_usage нет статистики
+PREGENERATE_TOKEN_ESTIMATE = {"generate_material": 4000, "generate_questions": 3000}
+
+
+def parse_days(value):
+    """"1-30" или "1,3,5-7" -> отсортированный список дней от 1 до 30."""
+    days = set()
+    try:
+        for part in filter(None, (part.strip() for part in value.split(","))):
+            start, _, end = part.partition("-")
+            days.update(range(int(start), int(end or start) + 1))
+    except ValueError:
+        raise click.BadParameter(f"ожидается диапазон вида 1-30 или 1,3,5-7: {value}")
+    if not days or min(days) < 1 or max(days) > 30:
+        raise click.BadParameter(f"дни должны быть от 1 до 30: {value}")
+    return sorted(days)
+
+
+def pregenerate_plan(languages, days, variants):
+    """
+    Недостающие варианты [(язык, день, вариант), ...] в порядке дней. Уже сохранённые в кэше
+    варианты — контрольная точка: повторный запуск продолжает с того, что не успел прерванный.
+    """
+    fresh_after = datetime.utcnow() - timedelta(seconds=CONTENT_CACHE_TTL)
+    fresh = {}
+    for language, day, variant, created_at in db.session.query(
+            ContentCache.language, ContentCache.day, ContentCache.variant, ContentCache.created_at
+    ).filter(ContentCache.language.in_(languages)):
+        if created_at >= fresh_after:
+            fresh.setdefault((language, day), set()).add(variant)
+    plan = []
+    for day in days:
+        for language in languages:
+            taken = fresh.get((language, day), set())
+            free = [variant for variant in range(MATERIAL_PROMPT_VARIANTS) if variant not in taken]
+            plan.extend((language, day, variant) for variant in free[:max(0, variants - len(taken))])
+    return plan
+
+
+def estimated_tokens_per_call():
+    """Средний расход токенов на вызов по token_usage (или PREGENERATE_TOKEN_ESTIMATE без статистики)."""
+    estimate = dict(PREGENERATE_TOKEN_ESTIMATE)
+    rows = db.session.query(
+        TokenUsage.function, db.func.sum(TokenUsage.calls),
+        db.func.sum(TokenUsage.prompt_tokens + TokenUsage.completion_tokens)
+    ).filter(TokenUsage.function.in_(estimate)).group_by(TokenUsage.function)
+    for function, calls, tokens in rows:
+        if calls:
+            estimate[function] = tokens / calls
+    return estimate
+
+
+def pregenerate_task(language, day, variant):
+    """Выполняется в процессе пула `flask pregenerate`: вариант контента и итоги вызовов модели (CallStats)."""
+    calls = []
+    llm.listeners.append(calls.append)
+    try:
+        return build_content(language, day, variant), calls
+    finally:
+        llm.listeners.remove(calls.append)
+
+
+def run_pregeneration(plan, workers):
+    """
+    Выполняет план в пуле процессов. В работе одновременно не больше limit задач: после задачи
+    с ответами 429 limit уменьшается вдвое, после задачи без них — растёт на 1 до workers.
+    Каждый вариант сохраняется в кэш сразу, поэтому прерванный запуск ничего не теряет.
+    """
+    pending = list(plan)
+    running = {}
+    limit = workers
+    stored = failed = 0
+    started = time.monotonic()
+    # spawn: процессы пула не наследуют соединения с базой и фоновые потоки родителя
+    pool = ProcessPoolExecutor(max_workers=workers, mp_context=multiprocessing.get_context("spawn"))
+    try:
+        while pending or running:
+            while pending and len(running) < limit:
+                task = pending.pop(0)
+                running[pool.submit(pregenerate_task, *task)] = task
+            finished, _ = wait(running, return_when=FIRST_COMPLETED)
+            for future in finished:
+                language, day, variant = running.pop(future)
+                try:
+                    content, calls = future.result()
+                    error = content_error(content)
+                except Exception as e:
+                    content, calls, error = None, [], str(e)
+                # Метрики и учёт токенов (user_id = 0) — как для вызовов в этом процессе
+                for stats in calls:
+                    for listener in llm.listeners:
+                        listener(stats)
+                throttled = sum(stats.throttled for stats in calls)
+                limit = max(1, limit // 2) if throttled else min(workers, limit + 1)
+                if error:
+                    failed += 1
+                else:
+                    store_cached_content(language, day, variant, content)
+                    render_markdown(content["material"])
+                    stored += 1
+                print(f"[{stored + failed}/{len(plan)}] {language}, день {day}, вариант {variant}: "
+                      + (f"ошибка: {error}" if error else "готово")
+                      + (f" (429: {throttled}, одновременно задач: {limit})" if throttled else ""))
+    except KeyboardInterrupt:
+        print("Прервано: готовые варианты сохранены, повторный запуск продолжит с оставшихся")
+    finally:
+        pool.shutdown(cancel_futures=True)
+    print(f"Сохранено вариантов: {stored}, ошибок: {failed}, за {time.monotonic() - started:.0f} с")
+
+
+@bp.cli.command("pregenerate")
+@click.option("--languages", required=True, help="Языки через запятую, например Python,Java")
+@click.option("--days", default="1-30", show_default=True, help="Дни: 1-30 или 1,3,5-7")
+@click.option("--variants", default=CONTENT_CACHE_VARIANTS, show_default=True, help="Вариантов на (язык, день)")
+@click.option("--workers", default=2, show_default=True, help="Процессов генерации (одновременных задач)")
+@click.option("--price", default=0.0, help="Стоимость 1000 токенов для оценки расходов")
+@click.option("--dry-run", is_flag=True, help="Только план и оценка расхода токенов")
+def pregenerate_command(languages, days, variants, workers, price, dry_run):
+    """
+    Заранее генерирует контент курсов в общий кэш, чтобы первый ученик дня не ждал модель.
+    Готовые варианты пропускаются: прерванный запуск продолжается повторным вызовом.
+    """
+    languages = [language.strip() for language in languages.split(",") if language.strip()]
+    days = parse_days(days)
+    variants = min(variants, MATERIAL_PROMPT_VARIANTS)
+    plan = pregenerate_plan(languages, days, variants)
+    estimate = estimated_tokens_per_call()
+    tokens = len(plan) * sum(estimate.values())
+    print(f"Вариантов к генерации: {len(plan)} (языков {len(languages)}, дней {len(days)}, до {variants} на день), "
+          f"вызовов модели: {len(plan) * len(estimate)}, токенов примерно: {tokens:,.0f}"
+          + (f", стоимость примерно: {tokens / 1000 * price:.2f}" if price else ""))
+    if variants < CONTENT_CACHE_VARIANTS:
+        print(f"Внимание: кэш отдаёт день, когда для него готово вариантов: {CONTENT_CACHE_VARIANTS} (CONTENT_CACHE_VARIANTS)")
+    if ContentCache.query.count() + len(plan) > CONTENT_CACHE_MAX_ENTRIES:
+        print(f"Внимание: записей кэша станет больше CONTENT_CACHE_MAX_ENTRIES={CONTENT_CACHE_MAX_ENTRIES}, "
+              "давно не использованные будут вытеснены")
+    if dry_run or not plan:
+        return
+
+    # Устаревшие по TTL варианты заменяются новыми
+    ContentCache.query.filter(
+        ContentCache.language.in_(languages),
+        ContentCache.created_at < datetime.utcnow() - timedelta(seconds=CONTENT_CACHE_TTL)
+    ).delete(synchronize_session=False)
+    db.session.commit()
+    run_pregeneration(plan, max(workers, 1))
+    flush_token_usage()
 
 
 # Лендинг-страница (доступна всем)
-@app.route("/")
+@bp.route("/")
 def landing():
     return render_template("landing.html")
 
 
 # Страница регистрации
-@app.route("/register", methods=["GET", "POST"])
+@bp.route("/register", methods=["GET", "POST"])
 def register():
     if request.method == "POST":
         username = request.form.get("username")
@@ -104,17 +1327,17 @@ def register():
         user = User.query.filter((User.username == username) | (User.email == email)).first()
         if user:
             flash("Пользователь с таким именем или email уже существует.", "danger")
-            return redirect(url_for("register"))
+            return redirect(url_for("main.register"))
         new_user = User(username=username, email=email, password=hashed_password)
         db.session.add(new_user)
         db.session.commit()
         flash("Аккаунт успешно создан! Теперь вы можете войти.", "success")
-        return redirect(url_for("login"))
+        return redirect(url_for("main.login"))
     return render_template("register.html")
 
 
 # Страница логина
-@app.route("/login", methods=["GET", "POST"])
+@bp.route("/login", methods=["GET", "POST"])
 def login():
     if request.method == "POST":
         email = request.form.get("email")
@@ -124,21 +1347,21 @@ def login():
             session["user_id"] = user.id
             session.permanent = True
             flash("Вы успешно вошли в систему!", "success")
-            return redirect(url_for("dashboard"))
+            return redirect(url_for("main.dashboard"))
         else:
             flash("Неверный email или пароль.", "danger")
     return render_template("login.html")
 
 
 
-@app.route("/logout")
+@bp.route("/logout")
 def logout():
     session.pop("user_id", None)
     flash("Вы вышли из системы.", "info")
-    return redirect(url_for("login"))
+    return redirect(url_for("main.login"))
 
 
-@app.route("/set_language", methods=["POST"])
+@bp.route("/set_language", methods=["POST"])
 @login_required
 def set_language():
     data = request.get_json()
@@ -146,7 +1369,7 @@ def set_language():
     return jsonify(success=True)
 
 # Панель управления (только для авторизованных)
-@app.route("/dashboard", methods=["GET", "POST"])
+@bp.route("/dashboard", methods=["GET", "POST"])
 @login_required
 def dashboard():
     user_id = session["user_id"]
@@ -156,7 +1379,7 @@ def dashboard():
         selected_language = request.form.get("language")
         if not selected_language:
             flash("Пожалуйста, выберите язык для изучения.", "warning")
-            return redirect(url_for("dashboard"))
+            return redirect(url_for("main.dashboard"))
 
         # Сбрасываем старый язык в сессии и пишем новый
         session.pop("selected_language", None)
@@ -177,36 +1400,28 @@ def dashboard():
                 incorrect_percentage=None
             )
             db.session.add(new_training)
-            db.session.commit()
+            record_progress(user_id, selected_language, 1, False)
+            try:
+                db.session.commit()
+            except IntegrityError:
+                # Запись первого дня уже создал параллельный запрос
+                db.session.rollback()
             flash(f"Выбран язык: {selected_language}. Запись создана, начинаем обучение!", "success")
         else:
             flash(f"Вы уже изучаете {selected_language}. Продолжаем обучение!", "info")
 
-        return redirect(url_for("training"))
-
-    # Собираем все языки, у которых есть TrainingData в диапазоне 1..30
-    languages = db.session.query(TrainingData.language)\
-        .filter(TrainingData.user_id == user_id, TrainingData.day.between(1, 30))\
-        .distinct().all()
-    languages = [l[0] for l in languages]
+        return redirect(url_for("main.training"))
 
-    # Разделяем на незавершённые и завершённые
+    # Разделяем языки на незавершённые и завершённые одним запросом к Progress
     active_languages = {}
     completed_languages = {}
 
-    for lang in languages:
-        # Находим последнюю запись по дню
-        last_record = TrainingData.query.filter_by(user_id=user_id, language=lang)\
-            .order_by(TrainingData.day.desc()).first()
-        if not last_record:
-            continue
-
-        # Если день < 30 ИЛИ correct_percentage is None => обучение не завершено
-        if last_record.day < 30 or last_record.correct_percentage is None:
-            active_languages[lang] = last_record.day
+    for progress in Progress.query.filter(Progress.user_id == user_id, Progress.last_day >= 1).all():
+        # Обучение завершено, если оценён 30-й день
+        if progress.is_complete:
+            completed_languages[progress.language] = progress.last_day
         else:
-            # Иначе считаем обучение завершённым
-            completed_languages[lang] = last_record.day
+            active_languages[progress.language] = progress.last_day
 
     popular_languages = ["Python", "JavaScript", "Java", "C++", "Ruby"]
 
@@ -219,22 +1434,24 @@ def dashboard():
     )
 
 
-@app.route("/reset_training/<language>", methods=["POST"])
+@bp.route("/reset_training/<language>", methods=["POST"])
 @login_required
 def reset_training(language):
     user_id = session["user_id"]
     # Удаляем все записи из TrainingData и Summary
     TrainingData.query.filter_by(user_id=user_id, language=language).delete()
     Summary.query.filter_by(user_id=user_id, language=language).delete()
+    GenerationJob.query.filter_by(user_id=user_id, language=language).delete()
+    Progress.query.filter_by(user_id=user_id, language=language).delete()
     db.session.commit()
 
     # Очищаем sessionStorage на клиенте
     flash(f"Обучение по {language} было сброшено.", "danger")
-    return redirect(url_for("dashboard"))
+    return redirect(url_for("main.dashboard"))
 
 
 # Маршрут для страницы обучения
-@app.route("/training", methods=["GET", "POST"])
+@bp.route("/training", methods=["GET", "POST"])
 @login_required
 def training():
     if request.method == "POST":
@@ -247,18 +1464,10 @@ def training():
         user = User.query.get(session["user_id"])
         selected_language = session.get("selected_language")
         # Получаем последнюю запись по выбранному языку
-        current_training = TrainingData.query.filter_by(
-            user_id=user.id, language=selected_language
-        ).order_by(TrainingData.day.desc()).first()
-
-        # Извлекаем текст вопросов из записи (предполагаем, что вопросы разделены двойным переносом строки)
-        question_blocks = re.split(r"\n\s*\n", current_training.questions.strip())
-        questions_dict = {}
-        for i, block in enumerate(question_blocks, start=1):
-            # Для каждого блока берем первую строку, которая содержит текст вопроса
-            lines = block.splitlines()
-            if lines:
-                questions_dict[str(i)] = lines[0].strip()
+        current_training = get_latest_training(user.id, selected_language)
+
+        # Формулировки вопросов по их номерам из сохранённой структуры
+        questions_dict = {str(item["number"]): item["stem"] for item in question_items_of(content_of(current_training))}
 
         # Комбинируем вопросы и ответы в один словарь
         combined = {}
@@ -269,63 +1478,29 @@ def training():
         # Сохраняем комбинированные данные в поле answers записи TrainingData
         current_training.answers = json.dumps(combined, ensure_ascii=False)
         db.session.commit()
+        prefetch_next_day(user.id, selected_language, current_training.day)
         session["submitted_answers"] = combined
         flash("Ваши ответы сохранены!", "success")
-        return redirect(url_for("review"))
+        return redirect(url_for("main.review"))
 
     return render_template("training.html", selected_language=session.get("selected_language"))
 
 
-@app.route("/generate_training", methods=["GET"])
+@bp.route("/generate_training", methods=["GET"])
 @login_required
+@metrics.traced("generate_training")
 def generate_training():
     user = User.query.get(session["user_id"])
     selected_language = session.get("selected_language")
     if not selected_language:
         return jsonify({"error": "Язык не выбран"}), 400
 
-    # Получаем последнюю запись по данному пользователю и языку
-    latest_training = TrainingData.query.filter_by(
-        user_id=user.id, language=selected_language
-    ).order_by(TrainingData.day.desc()).first()
-
-    # Если день 0 найден, пропускаем его и начинаем с 1
-    if latest_training and latest_training.day == 0:
-        current_day = 1
-    elif latest_training:
-        # Если последний день завершён (есть correct_percentage), переходим к следующему дню
-        if latest_training.correct_percentage is not None:
-            current_day = latest_training.day + 1
-        else:
-            # Если материал и вопросы есть, просто возвращаем существующую запись
-            if latest_training.material and latest_training.questions:
-                return jsonify({
-                    "day": latest_training.day,
-                    "material": latest_training.material,
-                    "questions": latest_training.questions
-                })
-            # Иначе продолжаем с тем же днём, но с генерацией материалов
-            current_day = latest_training.day
-    else:
-        # Если записей нет, начинаем с 1 дня
-        current_day = 1
+    current_day = get_current_day(user.id, selected_language)
 
     # Ограничиваем диапазон дней от 1 до 30
     if current_day > 30:
         return jsonify({"error": "Вы завершили обучение для этого языка"}), 400
 
-    # Если 30-й день уже есть и материалы заполнены, возвращаем их
-    if current_day == 30:
-        existing_day30 = TrainingData.query.filter_by(
-            user_id=user.id, language=selected_language, day=30
-        ).first()
-        if existing_day30 and existing_day30.material and existing_day30.questions:
-            return jsonify({
-                "day": existing_day30.day,
-                "material": existing_day30.material,
-                "questions": existing_day30.questions
-            })
-
     # Проверяем, есть ли запись для текущего дня с материалами и вопросами
     existing_training = TrainingData.query.filter_by(
         user_id=user.id, language=selected_language, day=current_day
@@ -333,47 +1508,146 @@ def generate_training():
 
     if existing_training and existing_training.material and existing_training.questions:
         # Если запись есть и материалы уже заполнены, просто возвращаем их
-        return jsonify({
-            "day": existing_training.day,
-            "material": existing_training.material,
-            "questions": existing_training.questions
-        })
-    else:
-        # Генерируем новый материал и вопросы для текущего дня
-        material = generate_material(selected_language, current_day)
-        material = re.sub(r"^День\s*\d+\s*:\s*", "", material, flags=re.IGNORECASE)
-        questions = generate_questions(selected_language, material, current_day)
-        questions = clean_questions_text(questions)
+        return content_response(existing_training.day, content_of(existing_training))
+
+    # Попадание в общий кэш отдаём сразу, без фоновой задачи.
+    # Сверх дневного лимита токенов подходит любой вариант, даже если пул ещё не заполнен
+    over_budget = over_token_budget(user.id)
+    cached = get_cached_content(selected_language, current_day, min_variants=1 if over_budget else CONTENT_CACHE_VARIANTS)
+    if cached:
+        save_training_content(user.id, selected_language, current_day, content_of(cached))
+        return content_response(current_day, content_of(cached))
+
+    # Иначе генерируем в фоне: клиент опрашивает /generation_status/<job_id>.
+    # Материал, уже полученный потоком (/stream_material), повторно не генерируется,
+    # а пока он стримится в другой вкладке, клиент повторяет запрос позже
+    streamed_material = existing_training.material if existing_training else None
+    if not streamed_material and lease_active(stream_flight_key(user.id, selected_language, current_day)):
+        return jsonify({"status": "pending", "day": current_day}), 202
+    job = enqueue_generation_job(user.id, selected_language, current_day, material=streamed_material)
+    return generation_job_response(job)
+
+
+def generation_job_response(job):
+    if job.status == "done":
+        save_training_content(job.user_id, job.language, job.day, content_of(job))
+        return content_response(job.day, content_of(job), job_id=job.id, status=job.status)
+    if job.status == "failed":
+        return jsonify({"error": job.error, "job_id": job.id, "status": job.status}), 500
+    payload = {"job_id": job.id, "status": job.status, "day": job.day}
+    if job.status == "queued" and job.lease_until and job.lease_until > datetime.utcnow():
+        # Задача отложена из-за лимита токенов
+        payload["message"] = job.error
+    return jsonify(payload), 202
+
+
+def stream_flight_key(user_id, language, day):
+    """Ключ аренды, пока материал дня стримится (см. stream_material_events)."""
+    return f"stream:{user_id}:{language}:{day}"
+
+
+@bp.route("/stream_material", methods=["GET"])
+@login_required
+def stream_material_events():
+    """
+    Отдаёт обучающий материал текущего дня потоком (server-sent events) по мере генерации.
+    Когда поток завершён, материал сохраняется в TrainingData, а вопросы создаются фоновой задачей.
+    """
+    user_id = session["user_id"]
+    selected_language = session.get("selected_language")
 
-        if existing_training:
-            # Если запись уже была, просто обновляем её
-            existing_training.material = material
-            existing_training.questions = questions
-        else:
-            # Если записи нет, создаём новую
-            new_training = TrainingData(
-                user_id=user.id,
-                day=current_day,
-                language=selected_language,
-                material=material,
-                questions=questions,
-                answers=None,
-                correct_percentage=None,
-                incorrect_percentage=None,
-                recommendation=None
-            )
-            db.session.add(new_training)
+    def event(payload):
+        return f"data: {json.dumps(payload, ensure_ascii=False)}\n\n"
+
+    def generate():
+        if not selected_language:
+            yield event({"error": "Язык не выбран"})
+            return
+        current_day = get_current_day(user_id, selected_language)
+        if current_day > 30:
+            yield event({"error": "Вы завершили обучение для этого языка"})
+            return
+
+        # Готовый материал (в записи пользователя, в общем кэше или в задаче) отдаём одним куском
+        record = TrainingData.query.filter_by(user_id=user_id, language=selected_language, day=current_day).first()
+        material = record.material if record and record.material else None
+        if not material:
+            cached = get_cached_content(selected_language, current_day)
+            if cached:
+                save_training_content(user_id, selected_language, current_day, content_of(cached))
+                material = cached.material
+        if not material:
+            job = GenerationJob.query.filter_by(
+                user_id=user_id, language=selected_language, day=current_day, status="done"
+            ).first()
+            if job:
+                save_training_content(user_id, selected_language, current_day, content_of(job))
+                material = job.material
+        if material:
+            yield event({"chunk": material})
+            yield event({"done": True, "day": current_day})
+            return
+        if over_token_budget(user_id):
+            # Сверх лимита не стримим: клиент получит день через /generate_training (кэш или очередь)
+            yield event({"done": True, "day": current_day})
+            return
+
+        # Материал этого дня уже стримится в другой вкладке или процессе: не генерируем второй раз
+        # и не держим поток обработчика — клиент дождётся дня опросом /generate_training
+        flight_key = stream_flight_key(user_id, selected_language, current_day)
+        owner = acquire_lease(flight_key)
+        if not owner:
+            yield event({"pending": True, "day": current_day})
+            return
+
+        try:
+            variant = pick_content_variant(selected_language, current_day)
+            release_db_connection()
+            parts = []
+            try:
+                for chunk in stream_material(selected_language, current_day, variant):
+                    parts.append(chunk)
+                    yield event({"chunk": chunk})
+            except Exception as e:
+                yield event({"error": str(e)})
+                return
+
+            material = re.sub(r"^День\s*\d+\s*:\s*", "", "".join(parts), flags=re.IGNORECASE)
+            record = TrainingData.query.filter_by(user_id=user_id, language=selected_language, day=current_day).first()
+            if record:
+                if not record.material:
+                    record.material = material
+            else:
+                db.session.add(TrainingData(user_id=user_id, day=current_day, language=selected_language,
+                                            material=material))
+                record_progress(user_id, selected_language, current_day, False)
+            try:
+                db.session.commit()
+            except IntegrityError:
+                # Запись дня создал параллельный запрос; материал всё равно передаётся в задачу ниже
+                db.session.rollback()
+            render_markdown(material)
+            enqueue_generation_job(user_id, selected_language, current_day, material=material, variant=variant)
+        finally:
+            release_lease(flight_key, owner)
+        yield event({"done": True, "day": current_day})
+
+    return Response(stream_with_context(generate()), mimetype="text/event-stream",
+                    headers={"Cache-Control": "no-cache", "X-Accel-Buffering": "no"})
 
-        db.session.commit()
 
-        return jsonify({
-            "day": current_day,
-            "material": material,
-            "questions": questions
-        })
+@bp.route("/generation_status/<job_id>", methods=["GET"])
+@login_required
+def generation_status(job_id):
+    job = db.session.get(GenerationJob, job_id)
+    if not job or job.user_id != session["user_id"]:
+        return jsonify({"error": "Задача не найдена"}), 404
+    # Обработчики могли не запуститься после перезапуска процесса
+    ensure_generation_workers()
+    return generation_job_response(job)
 
 
-@app.route("/retake_test", methods=["POST"])
+@bp.route("/retake_test", methods=["POST"])
 @login_required
 def retake_test():
     """
@@ -382,40 +1656,35 @@ def retake_test():
     """
     user_id = session["user_id"]
     selected_language = session.get("selected_language")
-    record = TrainingData.query.filter_by(
-        user_id=user_id, language=selected_language
-    ).order_by(TrainingData.day.desc()).first()
+    record = get_latest_training(user_id, selected_language)
     if record:
         record.correct_percentage = None
         record.incorrect_percentage = None
         record.recommendation = None
+        record.grade_provisional = False
+        progress = record_progress(user_id, selected_language, record.day, False)
+        rebuild_learning_stats(progress)
         db.session.commit()
         flash("Результаты сброшены. Пройдите тест ещё раз.", "info")
-    return redirect(url_for("training"))
+    return redirect(url_for("main.training"))
 
 
-@app.route("/next_day", methods=["POST"])
+@bp.route("/next_day", methods=["POST"])
 @login_required
 def next_day():
     user_id = session["user_id"]
     selected_language = session.get("selected_language")
-    record = TrainingData.query.filter_by(user_id=user_id, language=selected_language).order_by(
-        TrainingData.day.desc()).first()
-    if not record:
+    progress = get_progress(user_id, selected_language)
+    if not progress:
         flash("Нет данных для обучения", "warning")
-        return redirect(url_for("dashboard"))
+        return redirect(url_for("main.dashboard"))
 
-    current_day = record.day
+    current_day = progress.last_day
     if current_day >= 30:
-        # Если это 30-й день, агрегируем данные и записываем Summary
-        records = TrainingData.query.filter_by(user_id=user_id, language=selected_language).all()
-        valid_records = [r for r in records if r.correct_percentage is not None]
-        if valid_records:
-            overall_correct = sum(r.correct_percentage for r in valid_records) / len(valid_records)
-            overall_incorrect = sum(r.incorrect_percentage for r in valid_records) / len(valid_records)
-        else:
-            overall_correct = 0
-            overall_incorrect = 0
+        # Если это 30-й день, записываем Summary по накопленной статистике
+        stats = learning_stats_view(progress)
+        overall_correct = stats["correct_avg"]
+        overall_incorrect = stats["incorrect_avg"]
         summary_text = f"Поздравляем! Это был последний день обучения. Ваш средний процент правильных ответов: {overall_correct:.2f}%."
         new_summary = Summary(
             user_id=user_id,
@@ -427,71 +1696,344 @@ def next_day():
         )
         db.session.add(new_summary)
         db.session.commit()
+        render_markdown(summary_text)
         flash("Вы завершили обучение! Просмотрите результаты обучения.", "success")
-        return redirect(url_for("dashboard"))
+        return redirect(url_for("main.dashboard"))
     else:
         # Если текущий день завершен (record.correct_percentage != None), переходим к следующему дню
         next_day = current_day + 1
         if next_day > 30:
             flash("Вы завершили обучение для этого языка.", "info")
-            return redirect(url_for("dashboard"))
-        return redirect(url_for("training"))
+            return redirect(url_for("main.dashboard"))
+        return redirect(url_for("main.training"))
+
+
+def evaluation_cache_key(language, evaluation_input, total):
+    """
+    Ключ кэша оценки. Нормализуются только форма Unicode, переводы строк и пробелы в конце строк:
+    отступы и регистр в коде значимы для оценки.
+    """
+    normalized = unicodedata.normalize("NFC", evaluation_input).replace("\r\n", "\n").replace("\r", "\n")
+    normalized = "\n".join(line.rstrip() for line in normalized.split("\n")).strip()
+    return hashlib.sha256(f"{language}\n{total}\n{normalized}".encode("utf-8")).hexdigest()
+
+
+def get_cached_evaluation(key):
+    """Сохранённый ответ модели или None; устаревшая по TTL запись удаляется."""
+    entry = db.session.get(EvaluationCache, key)
+    if entry is None:
+        return None
+    now = datetime.utcnow()
+    if entry.created_at < now - timedelta(seconds=EVALUATION_CACHE_TTL):
+        db.session.delete(entry)
+        db.session.commit()
+        return None
+    entry.hits = (entry.hits or 0) + 1
+    entry.last_used_at = now
+    response = entry.response
+    db.session.commit()
+    return response
+
 
+def store_cached_evaluation(key, response):
+    """Сохраняет ответ модели и вытесняет давно не использованные записи (LRU)."""
+    db.session.add(EvaluationCache(key=key, response=response))
+    try:
+        db.session.commit()
+    except IntegrityError:
+        # Те же ответы только что оценил параллельный запрос
+        db.session.rollback()
+        return
+    overflow = EvaluationCache.query.count() - EVALUATION_CACHE_MAX_ENTRIES
+    if overflow > 0:
+        stale_keys = [row.key for row in EvaluationCache.query.with_entities(EvaluationCache.key)
+                      .order_by(EvaluationCache.last_used_at.asc()).limit(overflow)]
+        EvaluationCache.query.filter(EvaluationCache.key.in_(stale_keys)).delete(synchronize_session=False)
+        db.session.commit()
+
+
+class EvaluationUnavailable(Exception):
+    pass
+
+
+async def evaluate_with_llm(language, answers_dict, total, choice_mistakes=(), allow_llm=True):
+    """
+    Оценка ответов нейросетью: (число правильных из total, рекомендации).
+    Повторная оценка тех же ответов берётся из кэша без вызова модели; если модель нужна,
+    а allow_llm ложно (исчерпан лимит токенов), бросает TokenBudgetExceeded.
+    Если модель не ответила в бюджет времени, бросает EvaluationUnavailable: оценка не записывается.
+    """
+    evaluation_input = ""
+    for q_num, qa in answers_dict.items():
+        evaluation_input += f"Вопрос {q_num}: {qa['question']} Ответ: {qa['answer']}\n"
+    if choice_mistakes:
+        # Тесты с вариантами уже проверены локально: сообщаем ошибки только для рекомендаций
+        evaluation_input += f"Кроме того, пользователь ошибся в вопросах с вариантами ответа: {', '.join(choice_mistakes)}\n"
+    evaluation_input = evaluation_input.strip()
+
+    cache_key = evaluation_cache_key(language, evaluation_input, total)
+    evaluation_response = get_cached_evaluation(cache_key)
+    cached = evaluation_response is not None
+    release_db_connection()
+    if not cached:
+        if not allow_llm:
+            raise TokenBudgetExceeded()
+        evaluation_response = await aevaluate_answers(language, evaluation_input, total)
+        if is_generation_error(evaluation_response):
+            raise EvaluationUnavailable(evaluation_response)
+    correct_match = re.search(rf"Количество правильных:\s*(\d+)\s*из\s*{total}", evaluation_response)
+    # Кэшируем только ответ в ожидаемом формате: ошибки модели оцениваются заново
+    if not cached and correct_match:
+        store_cached_evaluation(cache_key, evaluation_response)
+    correct_count = min(int(correct_match.group(1)), total) if correct_match else 0
+    rec_match = re.search(r"Рекомендации:\s*(.*)", evaluation_response, flags=re.DOTALL)
+    recommendation = rec_match.group(1).strip() if rec_match else "Нет рекомендаций"
+    return correct_count, recommendation
+
+
+def local_recommendation(choice_correct, choice_mistakes, failed_tests, unanswered):
+    """Рекомендации по результатам локальной проверки (ключ ответов и тесты в песочнице)."""
+    recommendation = f"Правильных ответов в вопросах с вариантами: {choice_correct} из 10."
+    if choice_mistakes:
+        recommendation += f" Повторите материал по вопросам {', '.join(choice_mistakes)}."
+    if failed_tests:
+        recommendation += f" Код в заданиях {', '.join(failed_tests)} не прошёл автоматические тесты — проверьте его."
+    if unanswered:
+        recommendation += (f" Практические задания {', '.join(unanswered)} остались без ответа — "
+                           "выполните их, чтобы закрепить материал.")
+    return recommendation
+
+
+async def grade_answers(language, answers_dict, answer_key, practical_tests=None, allow_llm=True):
+    """
+    Оценивает ответы дня: (число правильных из 15, рекомендации, предварительная ли оценка).
+    Вопросы 1-10 проверяются локально по ключу ответов, практические задания 11-15 с тестами —
+    запуском кода в песочнице (sandbox.py). Нейросети отправляются только оставшиеся
+    непустые практические ответы, а если таких нет, она не вызывается вовсе.
+    Без полного ключа (записи, созданные до его появления) все ответы оценивает нейросеть.
+    Если нейросеть нужна, но недоступна (не ответила или исчерпан лимит токенов, allow_llm ложно),
+    возвращается предварительная оценка по локальной проверке без непроверенных заданий.
+    """
+    if len(answer_key) < 10:
+        try:
+            return (*await evaluate_with_llm(language, answers_dict, 15, allow_llm=allow_llm), False)
+        except (EvaluationUnavailable, TokenBudgetExceeded):
+            return 0, ("Ответы сохранены, но сейчас их не удалось проверить нейросетью. "
+                       "Оценка предварительная и будет пересчитана автоматически."), True
+
+    choice_mistakes = [
+        q_num for q_num in map(str, range(1, 11))
+        if selected_option((answers_dict.get(q_num) or {}).get("answer")) != answer_key.get(q_num)
+    ]
+    choice_correct = 10 - len(choice_mistakes)
+    practical = {q_num: qa for q_num, qa in answers_dict.items() if int(q_num) > 10}
+    answered = {q_num: qa for q_num, qa in practical.items() if (qa.get("answer") or "").strip()}
+    unanswered = [q_num for q_num in practical if q_num not in answered]
+
+    tested = {}
+    if practical_tests and sandbox.supports(language):
+        tasks = {q_num: (qa["answer"], practical_tests[q_num])
+                 for q_num, qa in answered.items() if practical_tests.get(q_num)}
+        if tasks:
+            tested = await asyncio.to_thread(sandbox.grade_tasks, language, tasks)
+    failed_tests = [q_num for q_num, passed in tested.items() if not passed]
+    remaining = {q_num: qa for q_num, qa in answered.items() if q_num not in tested}
+    local_correct = choice_correct + sum(tested.values())
+
+    if not remaining:
+        return local_correct, local_recommendation(choice_correct, choice_mistakes, failed_tests, unanswered), False
+
+    try:
+        llm_correct, recommendation = await evaluate_with_llm(language, remaining, len(remaining), choice_mistakes,
+                                                              allow_llm)
+    except (EvaluationUnavailable, TokenBudgetExceeded):
+        recommendation = local_recommendation(choice_correct, choice_mistakes, failed_tests, unanswered)
+        recommendation += (f" Задания {', '.join(remaining)} сейчас не удалось проверить нейросетью: "
+                           "оценка предварительная и будет пересчитана, когда проверка станет доступна.")
+        return local_correct, recommendation, True
+    return local_correct + llm_correct, recommendation, False
+
+
+class AnswersChanged(Exception):
+    pass
+
+
+def stored_grade(record_id, graded_answers):
+    """
+    Записанная оценка дня (correct, recommendation, provisional) или None, если день ещё не оценён.
+    Бросает AnswersChanged, если ответы дня заменили или день удалён.
+    """
+    row = db.session.query(TrainingData.correct_percentage, TrainingData.recommendation,
+                           TrainingData.grade_provisional, TrainingData._answers,
+                           TrainingData.answers_blob).filter_by(id=record_id).first()
+    release_db_connection()
+    if row is None or (row[3], row[4]) != graded_answers:
+        raise AnswersChanged()
+    return (row[0], row[1], row[2]) if row[0] is not None else None
 
-@app.route("/review_data", methods=["GET"])
+
+async def grade_training_day(flight_key, user_id, language, record_id, day, graded_answers,
+                             answers_dict, answer_key, practical_tests, allow_llm, regrade=False):
+    """
+    Оценивает ответы дня и записывает результат; возвращает (correct, recommendation, provisional).
+    regrade — пересчёт предварительной оценки: она заменяется только окончательной.
+    На время оценки ключ flight_key арендуется в базе: другой процесс с теми же ответами
+    не вызывает модель повторно, а дожидается записанного результата.
+    """
+    owner = acquire_lease(flight_key)
+    while not owner:
+        await asyncio.sleep(FLIGHT_POLL_INTERVAL)
+        result = stored_grade(record_id, graded_answers)
+        if result and not (regrade and result[2]):
+            return result
+        # Аренда освобождается после записи результата или истекает, если процесс-владелец упал
+        owner = acquire_lease(flight_key)
+
+    try:
+        correct_count, recommendation, provisional = await grade_answers(language, answers_dict, answer_key,
+                                                                         practical_tests, allow_llm)
+        correct = (correct_count / 15) * 100
+        if regrade and provisional:
+            # Нейросеть всё ещё недоступна: записанная предварительная оценка остаётся
+            return correct, recommendation, provisional
+
+        # Условное обновление: при параллельной оценке того же дня статистика учитывает его один раз
+        graded = TrainingData.query.filter(
+            TrainingData.id == record_id,
+            TrainingData.grade_provisional.is_(True) if regrade else TrainingData.correct_percentage.is_(None),
+            TrainingData._answers.is_not_distinct_from(graded_answers[0]),
+            TrainingData.answers_blob.is_not_distinct_from(graded_answers[1])
+        ).update({
+            "correct_percentage": correct,
+            "incorrect_percentage": 100 - correct,
+            "recommendation": recommendation,
+            "grade_provisional": provisional
+        }, synchronize_session=False)
+        if graded:
+            progress = record_progress(user_id, language, day, True)
+            if regrade:
+                # Предварительный результат уже учтён в статистике: пересчитываем её по записям дней
+                rebuild_learning_stats(progress)
+            else:
+                record_grade(progress, correct, 100 - correct)
+            db.session.commit()
+            return correct, recommendation, provisional
+        # День оценил параллельный запрос (отдаём его результат) или ответы отправлены заново
+        db.session.rollback()
+        result = stored_grade(record_id, graded_answers)
+        if not result:
+            raise AnswersChanged()
+        return result
+    finally:
+        release_lease(flight_key, owner)
+
+
+async def review_grade(training_record, user_id, language):
+    """
+    Оценка дня (correct, recommendation, provisional): записанная или новая. Предварительная оценка
+    пересчитывается, если нейросеть может быть вызвана (лимит токенов не исчерпан).
+    """
+    allow_llm = not over_token_budget(user_id)
+    graded = training_record.correct_percentage is not None and bool(training_record.recommendation)
+    if graded and not (training_record.grade_provisional and allow_llm):
+        return (training_record.correct_percentage, training_record.recommendation,
+                training_record.grade_provisional)
+
+    answers_dict = json.loads(training_record.answers)
+    answer_key = json.loads(training_record.answer_key) if training_record.answer_key else {}
+    practical_tests = json.loads(training_record.practical_tests) if training_record.practical_tests else {}
+    # Оцениваемые ответы: при записи результата проверяем, что их не заменили за время оценки
+    graded_answers = (training_record._answers, training_record.answers_blob)
+    record_id, day = training_record.id, training_record.day
+    release_db_connection()
+    # Одновременные запросы оценки тех же ответов (вкладки, повторные запросы) получают один результат
+    flight_key = f"grade:{record_id}:{hashlib.sha256(repr(graded_answers).encode('utf-8')).hexdigest()}"
+    return await grading_flights.run(flight_key, lambda: grade_training_day(
+        flight_key, user_id, language, record_id, day, graded_answers,
+        answers_dict, answer_key, practical_tests, allow_llm, regrade=graded
+    ))
+
+
+# Предварительные оценки фоновые обработчики пересчитывают не чаще раза в PROVISIONAL_REGRADE_INTERVAL
+# секунд на день — и для дней, к результатам которых ученик больше не вернётся
+PROVISIONAL_REGRADE_INTERVAL = float(os.getenv("PROVISIONAL_REGRADE_INTERVAL", "300"))
+_regrade_after = {}
+_regrade_lock = threading.Lock()
+
+
+def regrade_provisional_day():
+    """Пересчитывает одну предварительную оценку; True, если попытка была."""
+    if llm.breaker.state == "open":
+        return False
+    now = time.monotonic()
+    records = TrainingData.query.filter(TrainingData.grade_provisional.is_(True))\
+        .order_by(TrainingData.id.asc()).limit(20).all()
+    with _regrade_lock:
+        for record_id in [key for key, retry_at in _regrade_after.items() if retry_at <= now]:
+            del _regrade_after[record_id]
+        record = next((r for r in records if r.id not in _regrade_after), None)
+        if record:
+            _regrade_after[record.id] = now + PROVISIONAL_REGRADE_INTERVAL
+    if record is None or over_token_budget(record.user_id):
+        return False
+    tags = call_tags.set({"user_id": record.user_id, "language": record.language})
+    try:
+        asyncio.run(review_grade(record, record.user_id, record.language))
+    except AnswersChanged:
+        db.session.rollback()
+    except Exception as e:
+        # Ошибка пересчёта не должна останавливать обработчик генерации; повтор — через интервал
+        db.session.rollback()
+        print(f"Ошибка пересчёта предварительной оценки дня {record.id}: {e}")
+    finally:
+        call_tags.reset(tags)
+    return True
+
+
+@bp.route("/review_data", methods=["GET"])
 @login_required
-def review_data():
+async def review_data():
     user_id = session["user_id"]
     selected_language = session.get("selected_language")
 
-    training_record = TrainingData.query.filter_by(
-        user_id=user_id, language=selected_language
-    ).order_by(TrainingData.day.desc()).first()
+    training_record = get_latest_training(user_id, selected_language)
 
     if not training_record or not training_record.answers:
         return jsonify({"error": "Нет данных для оценки"}), 400
 
-    # Если результаты уже оценены, используем их
-    if training_record.correct_percentage is not None and training_record.recommendation:
-        correct = training_record.correct_percentage
-        recommendation = training_record.recommendation
-    else:
-        answers_json = training_record.answers
-        answers_dict = json.loads(answers_json)
-        evaluation_input = ""
-        for q_num, qa in answers_dict.items():
-            evaluation_input += f"Вопрос {q_num}: {qa['question']} Ответ: {qa['answer']}\n"
-        evaluation_input = evaluation_input.strip()
-
-        # Анализируем ответы через нейросеть
-        evaluation_response = evaluate_answers(selected_language, evaluation_input)
-        correct_match = re.search(r"Количество правильных:\s*(\d+)\s*из\s*15", evaluation_response)
-        correct_count = int(correct_match.group(1)) if correct_match else 0
-        correct = (correct_count / 15) * 100
-        rec_match = re.search(r"Рекомендации:\s*(.*)", evaluation_response, flags=re.DOTALL)
-        recommendation = rec_match.group(1).strip() if rec_match else "Нет рекомендаций"
-
-        training_record.correct_percentage = correct
-        training_record.incorrect_percentage = 100 - correct
-        training_record.recommendation = recommendation
-        db.session.commit()
-
-    last_day = (training_record.day == 30)
+    day = training_record.day
+    prefetch_next_day(user_id, selected_language, day)
 
-    # Если это 30-й день, вычисляем средние значения по всем дням
+    # Записанная оценка или новая; если нейросеть недоступна — предварительная по локальной проверке
+    try:
+        correct, recommendation, provisional = await review_grade(training_record, user_id, selected_language)
+    except AnswersChanged:
+        # Ответы отправлены заново во время проверки: оцениваем новые
+        training_record = get_latest_training(user_id, selected_language)
+        if not training_record or not training_record.answers:
+            return jsonify({"error": "Нет данных для оценки"}), 400
+        day = training_record.day
+        try:
+            correct, recommendation, provisional = await review_grade(training_record, user_id, selected_language)
+        except AnswersChanged:
+            return jsonify({"error": "Ответы изменились во время проверки. Обновите страницу."}), 409
+
+    last_day = (day == 30)
+
+    # Если это 30-й день, берём средние значения из накопленной статистики
     if last_day:
-        records = TrainingData.query.filter_by(user_id=user_id, language=selected_language).all()
-        valid_records = [r for r in records if r.correct_percentage is not None and str(r.correct_percentage).strip()]
-
-        if valid_records:
-            avg_correct = sum(float(r.correct_percentage or 0) for r in valid_records) / len(valid_records)
-            avg_incorrect = sum(float(r.incorrect_percentage or 0) for r in valid_records) / len(valid_records)
-        else:
-            avg_correct = 0
-            avg_incorrect = 0
-
-        # Вызов функции evaluate_result для получения итогового summary
-        summary_text = evaluate_result(selected_language, avg_correct, avg_incorrect)
+        stats = get_learning_stats(user_id, selected_language)
+        avg_correct = stats["correct_avg"]
+        avg_incorrect = stats["incorrect_avg"]
+        over_budget = over_token_budget(user_id)
+        release_db_connection()
+
+        # Вызов функции evaluate_result для получения итогового summary; сверх лимита токенов
+        # или если нейросеть не ответила — шаблонный текст
+        summary_text = None if over_budget else await aevaluate_result(selected_language, avg_correct, avg_incorrect)
+        if is_generation_error(summary_text):
+            summary_text = (f"Поздравляем! Вы завершили обучение. "
+                            f"Ваш средний процент правильных ответов: {avg_correct:.2f}%.")
 
         # Обновляем или создаем запись в таблице Summary
         summary_record = Summary.query.filter_by(user_id=user_id, language=selected_language, day=30).first()
@@ -511,23 +2053,25 @@ def review_data():
             db.session.add(summary_record)
 
         db.session.commit()
+        render_markdown(summary_text)
 
     return jsonify({
         "correct_percentage": correct,
         "incorrect_percentage": 100 - correct,
         "recommendation": recommendation,
-        "day": training_record.day,
+        "provisional": provisional,
+        "day": day,
         "last_day": last_day
     })
 
 
-@app.route("/review", methods=["GET"])
+@bp.route("/review", methods=["GET"])
 @login_required
 def review():
     return render_template("review.html")
 
 
-@app.route("/summary")
+@bp.route("/summary")
 @login_required
 def summary():
     user_id = session["user_id"]
@@ -535,36 +2079,29 @@ def summary():
     # Получаем все записи по обучению, исключая день 0
     summary_records = Summary.query.filter(Summary.user_id == user_id, Summary.day != 0).all()
 
+    # Статистика всех языков пользователя одним запросом
+    all_stats = get_learning_stats(user_id)
+
     # Словарь для хранения агрегированных данных по языкам
     summary_data = {}
 
     for record in summary_records:
         language = record.language
-        training_data = TrainingData.query.filter_by(user_id=user_id, language=language).order_by(
-            TrainingData.day.asc()).all()
-
-        # Преобразуем correct_percentage и incorrect_percentage в числа
-        total_days = len(training_data)
-        total_correct = sum(
-            float(r.correct_percentage) for r in training_data if r.correct_percentage not in [None, ""])
-        total_incorrect = sum(
-            float(r.incorrect_percentage) for r in training_data if r.incorrect_percentage not in [None, ""])
-
-        avg_correct = round(total_correct / total_days, 2) if total_days else 0
-        avg_incorrect = round(total_incorrect / total_days, 2) if total_days else 0
+        stats = all_stats.get(language) or learning_stats_view(None)
 
         # Обработка Markdown для рекомендаций
-        recommendations = markdown.markdown(record.summary if record.summary else "Нет рекомендаций")
+        recommendations = render_markdown(record.summary if record.summary else "Нет рекомендаций")
 
-        summary_data[language] = {
-            "correct_avg": avg_correct,
-            "incorrect_avg": avg_incorrect,
-            "recommendations": recommendations
-        }
+        summary_data[language] = dict(
+            stats,
+            correct_avg=round(stats["correct_avg"], 2),
+            incorrect_avg=round(stats["incorrect_avg"], 2),
+            recommendations=recommendations
+        )
 
     return render_template("summary.html", summary_data=summary_data)
 
-@app.route("/summary_details/<language>")
+@bp.route("/summary_details/<language>")
 @login_required
 def summary_details(language):
     user_id = session["user_id"]
@@ -576,7 +2113,16 @@ def summary_details(language):
     return render_template("summary_details.html", language=language, training_data=training_data)
 
 
-@app.route("/daysdata")
+def history_days(user_id, language):
+    """Дни курса с результатами, без текстовых колонок."""
+    return db.session.query(
+        TrainingData.day, TrainingData.correct_percentage, TrainingData.incorrect_percentage
+    ).filter(
+        TrainingData.user_id == user_id, TrainingData.language == language, TrainingData.day > 0
+    ).order_by(TrainingData.day.asc()).all()
+
+
+@bp.route("/daysdata")
 @login_required
 def daysdata():
     user_id = session["user_id"]
@@ -585,31 +2131,65 @@ def daysdata():
     languages = db.session.query(TrainingData.language).filter_by(user_id=user_id).distinct().all()
     language_list = [lang[0] for lang in languages]
 
-    detailed_data = {}
-    for lang in language_list:
-        records = TrainingData.query.filter_by(user_id=user_id, language=lang).order_by(TrainingData.day.asc()).all()
+    # Страница отдаётся потоком по языкам и содержит только список дней и результаты;
+    # материал и ответы дня подгружаются с /daysdata/<language>/<day> при открытии вкладки
+    return stream_template(
+        "daysdata.html",
+        languages=language_list,
+        history_days=lambda language: history_days(user_id, language)
+    )
 
-        formatted_records = []
-        for record in records:
-            try:
-                parsed_answers = json.loads(record.answers) if record.answers and record.answers.strip() else {}
-            except json.JSONDecodeError:
-                parsed_answers = {}
 
-            formatted_record = {
+@bp.route("/daysdata/<language>")
+@login_required
+def daysdata_page(language):
+    """Постраничный список дней курса: ?page=1&per_page=10."""
+    # Текстовые колонки отложены, поэтому страница строк не тянет материал и ответы
+    page = db.paginate(
+        db.select(TrainingData).filter_by(user_id=session["user_id"], language=language)
+        .order_by(TrainingData.day.asc()),
+        page=request.args.get("page", 1, type=int),
+        per_page=request.args.get("per_page", 10, type=int),
+        max_per_page=30,
+        error_out=False
+    )
+    return jsonify({
+        "language": language,
+        "page": page.page,
+        "pages": page.pages,
+        "total": page.total,
+        "days": [
+            {
                 "day": record.day,
-                "language": record.language,
-                "material": markdown.markdown(record.material) if record.material else "<p>Нет материала</p>",
-                "answers": parsed_answers,  # Исправлено
                 "correct_percentage": record.correct_percentage,
-                "incorrect_percentage": record.incorrect_percentage,
+                "incorrect_percentage": record.incorrect_percentage
             }
-            formatted_records.append(formatted_record)
+            for record in page.items
+        ]
+    })
+
 
-        detailed_data[lang] = formatted_records
+@bp.route("/daysdata/<language>/<int:day>")
+@login_required
+def daysdata_day(language, day):
+    record = TrainingData.query.filter_by(user_id=session["user_id"], language=language, day=day).first()
+    if not record:
+        return jsonify({"error": "День не найден"}), 404
 
-    return render_template("daysdata.html", detailed_data=detailed_data)
+    try:
+        parsed_answers = json.loads(record.answers) if record.answers and record.answers.strip() else {}
+    except json.JSONDecodeError:
+        parsed_answers = {}
+
+    return jsonify({
+        "day": record.day,
+        "language": record.language,
+        "material": render_markdown(record.material) if record.material else "<p>Нет материала</p>",
+        "answers": parsed_answers,
+        "correct_percentage": record.correct_percentage,
+        "incorrect_percentage": record.incorrect_percentage,
+    })
 
 if __name__ == "__main__":
 
-    app.run(debug=True)
+    create_app().run(debug=True)
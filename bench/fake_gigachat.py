@@ -0,0 +1,137 @@
+import re
+import time
+import random
+import asyncio
+import threading
+from types import SimpleNamespace
+
+from gigachat.exceptions import ResponseError
+
+# Локальная замена клиента GigaChat для нагрузочных тестов: тот же интерфейс
+# (chat/achat/stream/astream), настраиваемые задержка, всплески 429 с Retry-After и доля ошибок 5xx.
+# Ответы имеют тот же формат, что и у модели, поэтому маршруты проходят весь путь разбора и оценки.
+
+MATERIAL = (
+    "### Введение\n\n"
+    "{language} — язык программирования. В этом дне разбираем тему {day}.\n\n"
+    + "\n\n".join(
+        f"### Раздел {n}\n\nОписание конструкции и пример её использования.\n\n"
+        "```\nprint(\"Пример\")\n```"
+        for n in range(1, 6)
+    )
+)
+
+QUESTIONS = "\n\n".join(
+    [f"{n}. Что выведет пример {n}?\n   A) 1\n   B) 2\n   C) 3\n   D) 4" for n in range(1, 11)]
+    + [f"{n}. Напишите программу, которая печатает сумму двух чисел из ввода ({n})" for n in range(11, 16)]
+) + "\n\nОтветы: " + ", ".join(f"{n}-{'ABCD'[n % 4]}" for n in range(1, 11))
+
+TESTS = '\nТесты: {' + ", ".join(f'"{n}": [{{"input": "2 3", "output": "5"}}]' for n in range(11, 16)) + '}'
+
+
+class FakeGigaChat:
+    """
+    latency — средняя задержка ответа в секундах (±jitter), throttle_rate — вероятность начала
+    всплеска из burst ответов 429 с Retry-After: retry_after, error_rate — доля ответов 500.
+    """
+
+    def __init__(self, latency=0.5, jitter=0.2, throttle_rate=0.0, burst=3, retry_after=1,
+                 error_rate=0.0, chunk_size=200, seed=None):
+        self.latency = latency
+        self.jitter = jitter
+        self.throttle_rate = throttle_rate
+        self.burst = burst
+        self.retry_after = retry_after
+        self.error_rate = error_rate
+        self.chunk_size = chunk_size
+        self.random = random.Random(seed)
+        self.calls = 0
+        self.throttled = 0
+        self.failed = 0
+        self._burst_left = 0
+        self._lock = threading.Lock()
+
+    def _delay(self):
+        with self._lock:
+            return max(0.0, self.latency + self.random.uniform(-self.jitter, self.jitter))
+
+    def _check_failure(self):
+        """Бросает ResponseError в формате SDK, если этот запрос должен завершиться 429 или 500."""
+        with self._lock:
+            self.calls += 1
+            if not self._burst_left and self.random.random() < self.throttle_rate:
+                self._burst_left = self.burst
+            if self._burst_left:
+                self._burst_left -= 1
+                self.throttled += 1
+                raise ResponseError("fake://chat/completions", 429, b"Too Many Requests",
+                                    {"Retry-After": str(self.retry_after)})
+            if self.random.random() < self.error_rate:
+                self.failed += 1
+                raise ResponseError("fake://chat/completions", 500, b"Internal Server Error", {})
+
+    @staticmethod
+    def _prompt(payload):
+        """Текст запроса: строка или словарь в формате Chat (с ограничением длины ответа)."""
+        if isinstance(payload, str):
+            return payload
+        return payload["messages"][-1]["content"]
+
+    def _answer(self, prompt):
+        if "тест из 15" in prompt:
+            return QUESTIONS + (TESTS if "Тесты:" in prompt else "")
+        if "Проанализируй" in prompt:
+            total = int(re.search(r"из (\d+)\n", prompt).group(1))
+            correct = self.random.randint(0, total)
+            return f"Количество правильных: {correct} из {total}\nРекомендации: повторите разделы 2 и 4."
+        if "завершил" in prompt or "прошёл тест" in prompt or "результаты теста" in prompt:
+            return "Количество правильных: 80%\nРекомендации: **Поздравляем** с завершением обучения!"
+        language = re.search(r"языка (\S+)", prompt)
+        day = re.search(r"(\d+)", prompt)
+        return MATERIAL.format(language=language.group(1) if language else "Python",
+                               day=day.group(1) if day else 1)
+
+    @staticmethod
+    def _usage(prompt, content):
+        prompt_tokens, completion_tokens = len(prompt) // 4, len(content) // 4
+        return SimpleNamespace(prompt_tokens=prompt_tokens, completion_tokens=completion_tokens,
+                               total_tokens=prompt_tokens + completion_tokens)
+
+    def _response(self, prompt):
+        content = self._answer(prompt)
+        return SimpleNamespace(choices=[SimpleNamespace(message=SimpleNamespace(content=content))],
+                               usage=self._usage(prompt, content))
+
+    def _chunks(self, prompt):
+        content = self._answer(prompt)
+        for start in range(0, len(content), self.chunk_size):
+            delta = SimpleNamespace(content=content[start:start + self.chunk_size])
+            yield SimpleNamespace(choices=[SimpleNamespace(delta=delta)])
+
+    def chat(self, payload):
+        prompt = self._prompt(payload)
+        time.sleep(self._delay())
+        self._check_failure()
+        return self._response(prompt)
+
+    async def achat(self, payload):
+        prompt = self._prompt(payload)
+        await asyncio.sleep(self._delay())
+        self._check_failure()
+        return self._response(prompt)
+
+    def stream(self, payload):
+        prompt = self._prompt(payload)
+        self._check_failure()
+        chunks = list(self._chunks(prompt))
+        for chunk in chunks:
+            time.sleep(self._delay() / len(chunks))
+            yield chunk
+
+    async def astream(self, payload):
+        prompt = self._prompt(payload)
+        self._check_failure()
+        chunks = list(self._chunks(prompt))
+        for chunk in chunks:
+            await asyncio.sleep(self._delay() / len(chunks))
+            yield chunk
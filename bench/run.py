@@ -0,0 +1,195 @@
+"""
+Нагрузочный тест маршрутов приложения с локальной заменой GigaChat (bench/fake_gigachat.py).
+
+Каждый симулированный пользователь регистрируется, выбирает язык и проходит --days дней:
+/generate_training (с ожиданием фоновой генерации), /training, /review_data, /next_day,
+после чего открывает /dashboard, /daysdata и /summary. Пользователи выполняются параллельно
+в --concurrency потоках через тестовый клиент Flask, база — временный файл SQLite.
+
+Пример:
+    python bench/run.py --users 20 --concurrency 8 --days 3 --latency 0.2 --throttle-rate 0.05
+"""
+import os
+import sys
+import json
+import time
+import argparse
+import tempfile
+import threading
+import contextvars
+from collections import defaultdict
+from concurrent.futures import ThreadPoolExecutor
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT)
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+
+
+def parse_args():
+    parser = argparse.ArgumentParser(description="Нагрузочный тест SyntaxWay с локальной заменой GigaChat")
+    parser.add_argument("--users", type=int, default=10, help="число симулированных пользователей")
+    parser.add_argument("--concurrency", type=int, default=4, help="число одновременно работающих пользователей")
+    parser.add_argument("--days", type=int, default=2, help="сколько дней проходит каждый пользователь")
+    parser.add_argument("--language", default="Python")
+    parser.add_argument("--latency", type=float, default=0.2, help="средняя задержка ответа модели, с")
+    parser.add_argument("--jitter", type=float, default=0.1)
+    parser.add_argument("--throttle-rate", type=float, default=0.0, help="вероятность всплеска 429")
+    parser.add_argument("--burst", type=int, default=3, help="длина всплеска 429")
+    parser.add_argument("--retry-after", type=int, default=1, help="Retry-After в ответах 429, с")
+    parser.add_argument("--error-rate", type=float, default=0.0, help="доля ответов 500")
+    parser.add_argument("--poll-interval", type=float, default=0.1, help="интервал опроса /generation_status, с")
+    parser.add_argument("--seed", type=int, default=1)
+    parser.add_argument("--json", help="записать результаты в JSON-файл")
+    return parser.parse_args()
+
+
+def percentile(values, percent):
+    """Процентиль методом ближайшего ранга."""
+    ordered = sorted(values)
+    index = max(0, min(len(ordered) - 1, int(round(percent / 100 * len(ordered) + 0.5)) - 1))
+    return ordered[index]
+
+
+class RouteStats:
+    def __init__(self):
+        self.latencies = []
+        self.queries = 0
+        self.errors = 0
+
+
+class Recorder:
+    """
+    Длительности запросов и число SQL-запросов по маршрутам; запросы фоновых потоков — отдельно.
+    Маршрут хранится в ContextVar: асинхронные представления выполняются в другом потоке,
+    но с копией контекста вызывающего.
+    """
+
+    def __init__(self):
+        self.routes = defaultdict(RouteStats)
+        self.background_queries = 0
+        self.current = contextvars.ContextVar("bench_route", default=None)
+        self.lock = threading.Lock()
+
+    def on_query(self, *args):
+        route = self.current.get()
+        with self.lock:
+            if route:
+                self.routes[route].queries += 1
+            else:
+                self.background_queries += 1
+
+    def call(self, route, request, *args, **kwargs):
+        token = self.current.set(route)
+        started = time.perf_counter()
+        try:
+            response = request(*args, **kwargs)
+            # Потоковые ответы (/daysdata) выполняют запросы при чтении тела
+            response.get_data()
+        except Exception as e:
+            print(f"{route}: {e!r}")
+            response = None
+        finally:
+            elapsed = time.perf_counter() - started
+            self.current.reset(token)
+        with self.lock:
+            stats = self.routes[route]
+            stats.latencies.append(elapsed)
+            if response is None or response.status_code >= 500:
+                stats.errors += 1
+        return response
+
+
+def answers_form(items):
+    return {f"answer_{item['number']}": item["options"][0] if item["options"] else "print(sum(map(int, input().split())))"
+            for item in items}
+
+
+def simulate_user(app, recorder, number, args):
+    client = app.test_client()
+    email = f"bench{number}@example.com"
+    recorder.call("/register", client.post, "/register",
+                  data={"username": f"bench{number}", "email": email, "password": "bench"})
+    recorder.call("/login", client.post, "/login", data={"email": email, "password": "bench"})
+    client.post("/set_language", json={"language": args.language})
+    recorder.call("/dashboard POST", client.post, "/dashboard", data={"language": args.language})
+
+    for _ in range(args.days):
+        response = recorder.call("/generate_training", client.get, "/generate_training")
+        while response is not None and response.status_code == 202:
+            time.sleep(args.poll_interval)
+            response = recorder.call("/generation_status", client.get,
+                                     f"/generation_status/{response.get_json()['job_id']}")
+        if response is None or response.status_code != 200:
+            return
+        recorder.call("/training POST", client.post, "/training", data=answers_form(response.get_json()["items"]))
+        recorder.call("/review_data", client.get, "/review_data")
+        recorder.call("/next_day", client.post, "/next_day")
+
+    recorder.call("/dashboard", client.get, "/dashboard")
+    recorder.call("/daysdata", client.get, "/daysdata")
+    recorder.call("/summary", client.get, "/summary")
+
+
+def main():
+    args = parse_args()
+    workdir = tempfile.mkdtemp(prefix="syntaxway-bench-")
+    os.environ["SQLALCHEMY_DATABASE_URI"] = "sqlite:///" + os.path.join(workdir, "bench.db")
+    os.environ.setdefault("GIGACHAT_API_KEY", "bench")
+    os.environ.setdefault("SECRET_KEY", "bench")
+
+    import AI
+    from fake_gigachat import FakeGigaChat
+    from sqlalchemy import event
+
+    fake = FakeGigaChat(latency=args.latency, jitter=args.jitter, throttle_rate=args.throttle_rate,
+                        burst=args.burst, retry_after=args.retry_after, error_rate=args.error_rate,
+                        seed=args.seed)
+    AI.giga = fake
+
+    import app as application
+    app = application.create_app()
+    recorder = Recorder()
+    with app.app_context():
+        event.listen(application.db.engine, "before_cursor_execute", recorder.on_query)
+
+    started = time.perf_counter()
+    with ThreadPoolExecutor(max_workers=args.concurrency) as pool:
+        for future in [pool.submit(simulate_user, app, recorder, n, args) for n in range(args.users)]:
+            future.result()
+    elapsed = time.perf_counter() - started
+
+    total_requests = sum(len(stats.latencies) for stats in recorder.routes.values())
+    print(f"\nПользователей: {args.users}, параллельно: {args.concurrency}, дней: {args.days}, "
+          f"время: {elapsed:.1f} с, запросов: {total_requests} ({total_requests / elapsed:.1f} в секунду)")
+    print(f"GigaChat: вызовов {fake.calls}, 429: {fake.throttled}, 500: {fake.failed}; "
+          f"SQL-запросов фоновых потоков: {recorder.background_queries}\n")
+    header = f"{'маршрут':<20} {'запросов':>8} {'в сек':>7} {'p50, мс':>9} {'p95, мс':>9} {'p99, мс':>9} {'SQL/запрос':>10} {'ошибок':>7}"
+    print(header)
+    print("-" * len(header))
+    report = {"elapsed": elapsed, "requests": total_requests, "gigachat_calls": fake.calls,
+              "gigachat_throttled": fake.throttled, "gigachat_failed": fake.failed,
+              "background_queries": recorder.background_queries, "routes": {}}
+    for route, stats in sorted(recorder.routes.items()):
+        count = len(stats.latencies)
+        row = {
+            "requests": count,
+            "throughput": count / elapsed,
+            "p50_ms": percentile(stats.latencies, 50) * 1000,
+            "p95_ms": percentile(stats.latencies, 95) * 1000,
+            "p99_ms": percentile(stats.latencies, 99) * 1000,
+            "queries_per_request": stats.queries / count,
+            "errors": stats.errors,
+        }
+        report["routes"][route] = row
+        print(f"{route:<20} {count:>8} {row['throughput']:>7.1f} {row['p50_ms']:>9.1f} {row['p95_ms']:>9.1f} "
+              f"{row['p99_ms']:>9.1f} {row['queries_per_request']:>10.1f} {stats.errors:>7}")
+
+    if args.json:
+        with open(args.json, "w", encoding="utf-8") as f:
+            json.dump(report, f, ensure_ascii=False, indent=2)
+    # Фоновые потоки генерации не останавливаются сами
+    os._exit(0)
+
+
+if __name__ == "__main__":
+    main()
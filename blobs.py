@@ -0,0 +1,33 @@
+import os
+import zlib
+import hashlib
+
+try:
+    import zstandard
+except ImportError:  # zstd не установлен: сжимаем zlib
+    zstandard = None
+
+# Сжатие текстов для таблицы content_blob. Кодек записывается в каждую строку,
+# поэтому блобы, сжатые zlib и zstd, читаются одинаково независимо от текущей настройки
+BLOB_CODEC = os.getenv("CONTENT_BLOB_CODEC", "zstd" if zstandard else "zlib")
+BLOB_LEVEL = int(os.getenv("CONTENT_BLOB_LEVEL", "9"))
+
+
+def content_hash(text):
+    return hashlib.sha256(text.encode("utf-8")).hexdigest()
+
+
+def compress(text):
+    """Сжатые байты текста и имя кодека."""
+    data = text.encode("utf-8")
+    if BLOB_CODEC == "zstd" and zstandard:
+        return zstandard.ZstdCompressor(level=BLOB_LEVEL).compress(data), "zstd"
+    return zlib.compress(data, min(BLOB_LEVEL, 9)), "zlib"
+
+
+def decompress(data, codec):
+    if codec == "zstd":
+        if not zstandard:
+            raise RuntimeError("Блоб сжат zstd, но пакет zstandard не установлен")
+        return zstandard.ZstdDecompressor().decompress(data).decode("utf-8")
+    return zlib.decompress(data).decode("utf-8")
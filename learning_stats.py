@@ -0,0 +1,58 @@
+import os
+
+# Накопительная статистика курса (пользователь, язык), обновляемая при оценке каждого дня.
+# Хранится в колонках Progress, поэтому сводкам не нужно перечитывать все дни.
+
+# День засчитывается в серию, если правильных ответов не меньше этого процента
+STREAK_PASS_PERCENT = float(os.getenv("STREAK_PASS_PERCENT", "50"))
+# Гистограмма результатов дней: 10 интервалов по 10%, последний включает 100%
+HISTOGRAM_BUCKETS = 10
+
+STAT_FIELDS = ("graded_days", "correct_sum", "incorrect_sum", "correct_min", "correct_max",
+               "streak", "best_streak", "histogram")
+
+
+def empty():
+    return {
+        "graded_days": 0,
+        "correct_sum": 0.0,
+        "incorrect_sum": 0.0,
+        "correct_min": None,
+        "correct_max": None,
+        "streak": 0,
+        "best_streak": 0,
+        "histogram": [0] * HISTOGRAM_BUCKETS,
+    }
+
+
+def bucket(correct):
+    return min(max(int(correct // (100 / HISTOGRAM_BUCKETS)), 0), HISTOGRAM_BUCKETS - 1)
+
+
+def add_result(stats, correct, incorrect):
+    """Учитывает результат очередного оценённого дня; возвращает новый словарь статистики."""
+    stats = dict(stats, histogram=list(stats["histogram"]))
+    stats["graded_days"] += 1
+    stats["correct_sum"] += correct
+    stats["incorrect_sum"] += incorrect
+    stats["correct_min"] = correct if stats["correct_min"] is None else min(stats["correct_min"], correct)
+    stats["correct_max"] = correct if stats["correct_max"] is None else max(stats["correct_max"], correct)
+    stats["streak"] = stats["streak"] + 1 if correct >= STREAK_PASS_PERCENT else 0
+    stats["best_streak"] = max(stats["best_streak"], stats["streak"])
+    stats["histogram"][bucket(correct)] += 1
+    return stats
+
+
+def compute(results):
+    """Статистика по результатам [(correct, incorrect), ...] в порядке дней — для пересчёта с нуля."""
+    stats = empty()
+    for correct, incorrect in results:
+        stats = add_result(stats, correct, incorrect or 0)
+    return stats
+
+
+def averages(stats):
+    """Средние проценты правильных и неправильных ответов по оценённым дням."""
+    if not stats["graded_days"]:
+        return 0, 0
+    return stats["correct_sum"] / stats["graded_days"], stats["incorrect_sum"] / stats["graded_days"]
@@ -0,0 +1,381 @@
+import re
+import math
+import time
+import asyncio
+import random
+import threading
+import contextvars
+from collections import deque
+from email.utils import parsedate_to_datetime
+from datetime import datetime, timezone
+
+
+# Атрибуты текущего вызова (например, пользователь и язык) для учёта токенов; задаются вызывающим кодом
+call_tags = contextvars.ContextVar("llm_call_tags", default={})
+
+
+class LLMError(Exception):
+    """Запрос к модели не удался (исчерпан дедлайн, ошибка не подлежит повтору и т.п.)."""
+
+
+class CircuitOpenError(LLMError):
+    """Circuit breaker разомкнут: сервис недавно был недоступен, запрос не отправляется."""
+
+
+class CircuitBreaker:
+    """
+    Общий для процесса предохранитель: после failure_threshold подряд идущих ошибок
+    запросы сразу отклоняются в течение reset_timeout секунд, затем пропускается
+    один пробный запрос.
+    """
+
+    def __init__(self, failure_threshold=5, reset_timeout=30):
+        self.failure_threshold = failure_threshold
+        self.reset_timeout = reset_timeout
+        self._failures = 0
+        self._opened_at = None
+        self._probe_in_flight = False
+        self._probe_owner = None
+        self._lock = threading.Lock()
+
+    @property
+    def state(self):
+        with self._lock:
+            if self._opened_at is None:
+                return "closed"
+            if time.monotonic() - self._opened_at >= self.reset_timeout:
+                return "half-open"
+            return "open"
+
+    def allow(self, owner=None):
+        """Можно ли отправить запрос; owner — вызов, который займёт пробный запрос (см. release_probe)."""
+        with self._lock:
+            if self._opened_at is None:
+                return True
+            if time.monotonic() - self._opened_at < self.reset_timeout or self._probe_in_flight:
+                return False
+            self._probe_in_flight = True
+            self._probe_owner = owner
+            return True
+
+    def release_probe(self, owner):
+        """Освобождает пробный запрос, занятый owner, без учёта успеха или ошибки (вызов отменён)."""
+        with self._lock:
+            if self._probe_in_flight and self._probe_owner is owner:
+                self._probe_in_flight = False
+                self._probe_owner = None
+
+    def record_success(self):
+        with self._lock:
+            self._failures = 0
+            self._opened_at = None
+            self._probe_in_flight = False
+            self._probe_owner = None
+
+    def record_failure(self):
+        with self._lock:
+            self._failures += 1
+            self._probe_in_flight = False
+            self._probe_owner = None
+            if self._opened_at is not None or self._failures >= self.failure_threshold:
+                self._opened_at = time.monotonic()
+
+
+def error_status(error):
+    """HTTP-статус ошибки GigaChat (ResponseError(url, status, content, headers)) или None."""
+    args = getattr(error, "args", ())
+    if len(args) >= 2 and isinstance(args[1], int):
+        return args[1]
+    response = getattr(error, "response", None)
+    if response is not None and isinstance(getattr(response, "status_code", None), int):
+        return response.status_code
+    match = re.search(r"\b(429|5\d\d)\b", str(error))
+    return int(match.group(1)) if match else None
+
+
+def parse_retry_after(error):
+    """Значение Retry-After в секундах (число или HTTP-дата) или None."""
+    args = getattr(error, "args", ())
+    headers = args[3] if len(args) >= 4 else getattr(getattr(error, "response", None), "headers", None)
+    value = None
+    if headers is not None:
+        try:
+            value = headers.get("Retry-After")
+        except AttributeError:
+            value = None
+    if value is None:
+        match = re.search(r"Retry-After:\s*([^\r\n]+)", str(error))
+        value = match.group(1) if match else None
+    if value is None:
+        return None
+    value = str(value).strip()
+    if value.isdigit():
+        return float(value)
+    try:
+        retry_at = parsedate_to_datetime(value)
+    except (TypeError, ValueError):
+        return None
+    return max(0.0, (retry_at - datetime.now(timezone.utc)).total_seconds())
+
+
+def is_retryable(error):
+    """Повторяем 429, 5xx и сетевые ошибки; прочие 4xx (например, 401) и LLMError (например, нет ключа) — нет."""
+    if isinstance(error, LLMError):
+        return False
+    status = error_status(error)
+    return status is None or status == 429 or status >= 500
+
+
+def chat_payload(prompt, max_tokens=None):
+    """Запрос к GigaChat: строка или, если задано ограничение длины ответа, словарь в формате Chat."""
+    if not max_tokens:
+        return prompt
+    return {"messages": [{"role": "user", "content": prompt}], "max_tokens": max_tokens}
+
+
+class CallStats:
+    """Итог одного вызова: число попыток, длительность и израсходованные токены."""
+
+    def __init__(self, name, model=None):
+        self.name = name
+        self.model = model
+        self.tags = call_tags.get()
+        self.attempts = 0
+        self.throttled = 0
+        self.latency = 0.0
+        self.ok = False
+        # Отменён вызывающим (проигравший подстраховочный запрос), а не завершился ошибкой
+        self.cancelled = False
+        self.prompt_tokens = 0
+        self.completion_tokens = 0
+
+    def record_usage(self, result):
+        usage = getattr(result, "usage", None)
+        if usage is not None:
+            self.prompt_tokens = getattr(usage, "prompt_tokens", 0) or 0
+            self.completion_tokens = getattr(usage, "completion_tokens", 0) or 0
+
+
+class LatencyTracker:
+    """Скользящее окно длительностей успешных вызовов по ключам (функция, модель): порог подстраховки и выбор модели."""
+
+    def __init__(self, window=200, min_samples=20):
+        self.window = window
+        self.min_samples = min_samples
+        self._samples = {}
+        self._lock = threading.Lock()
+
+    def observe(self, name, seconds):
+        with self._lock:
+            self._samples.setdefault(name, deque(maxlen=self.window)).append(seconds)
+
+    def percentile(self, name, percent, default=None):
+        """Процентиль методом ближайшего ранга или default, пока замеров меньше min_samples."""
+        with self._lock:
+            ordered = sorted(self._samples.get(name, ()))
+        if len(ordered) < self.min_samples:
+            return default
+        return ordered[min(len(ordered) - 1, max(0, math.ceil(percent / 100 * len(ordered)) - 1))]
+
+
+class ModelRouter:
+    """
+    Автоматический выбор модели для функции: самая дешёвая из models (список от дешёвой к дорогой),
+    у которой p95 длительности укладывается в цель, а доля ответов в ожидаемом формате не ниже min_success.
+    Модель без достаточной статистики считается подходящей; с вероятностью explore запрос уходит
+    к случайной более дешёвой модели, чтобы статистика по ней обновлялась.
+    """
+
+    def __init__(self, models, latencies, min_success=0.9, explore=0.05, window=200, min_samples=20):
+        self.models = list(models)
+        self.latencies = latencies
+        self.min_success = min_success
+        self.explore = explore
+        self.window = window
+        self.min_samples = min_samples
+        self._results = {}
+        self._lock = threading.Lock()
+
+    def observe(self, name, model, parsed):
+        """Итог вызова model для функции name: ответ в ожидаемом формате или нет (в том числе ошибка)."""
+        with self._lock:
+            self._results.setdefault((name, model), deque(maxlen=self.window)).append(bool(parsed))
+
+    def success_rate(self, name, model):
+        with self._lock:
+            results = list(self._results.get((name, model), ()))
+        if len(results) < self.min_samples:
+            return None
+        return sum(results) / len(results)
+
+    def select(self, name, target):
+        chosen = len(self.models) - 1
+        for index, model in enumerate(self.models):
+            p95 = self.latencies.percentile((name, model), 95)
+            rate = self.success_rate(name, model)
+            if (p95 is None or p95 <= target) and (rate is None or rate >= self.min_success):
+                chosen = index
+                break
+        if chosen and random.random() < self.explore:
+            return random.choice(self.models[:chosen])
+        return self.models[chosen]
+
+
+class LLMClient:
+    """
+    Единая точка вызова GigaChat для всех функций AI.py.
+
+    Каждая попытка проходит через общий circuit breaker; между попытками —
+    экспоненциальная задержка с full jitter или Retry-After из ответа 429.
+    Вызов прекращается, когда следующая попытка не укладывается в дедлайн.
+    """
+
+    def __init__(self, client_getter, breaker=None, deadline=300, max_attempts=30,
+                 backoff_base=1.0, backoff_cap=60.0):
+        self.client_getter = client_getter
+        self.breaker = breaker or CircuitBreaker()
+        self.deadline = deadline
+        self.max_attempts = max_attempts
+        self.backoff_base = backoff_base
+        self.backoff_cap = backoff_cap
+        self.listeners = []
+
+    def backoff(self, attempt):
+        return random.uniform(0, min(self.backoff_cap, self.backoff_base * 2 ** (attempt - 1)))
+
+    def _report(self, stats):
+        outcome = "успех" if stats.ok else "отменён" if stats.cancelled else "ошибка"
+        print(f"{stats.name}{' (' + stats.model + ')' if stats.model else ''}: {outcome}, попыток {stats.attempts}, "
+              f"429: {stats.throttled}, {stats.latency:.1f} с")
+        for listener in self.listeners:
+            listener(stats)
+
+    def _retry_delay(self, stats, error, started, deadline):
+        """
+        Учитывает неудачную попытку и возвращает паузу перед следующей
+        или бросает LLMError, если повторять нельзя или не успеваем в дедлайн.
+        """
+        status = error_status(error)
+        if status == 429:
+            stats.throttled += 1
+            # Ограничение частоты — не признак недоступности сервиса
+            self.breaker.record_success()
+        elif is_retryable(error):
+            self.breaker.record_failure()
+        else:
+            self.breaker.record_success()
+            raise LLMError(str(error)) from error
+        if stats.attempts >= self.max_attempts:
+            raise LLMError(f"{stats.attempts} попыток: {error}") from error
+        delay = parse_retry_after(error) if status == 429 else None
+        if delay is None:
+            delay = self.backoff(stats.attempts)
+        if time.monotonic() - started + delay > deadline:
+            raise LLMError(f"дедлайн {deadline} с исчерпан после {stats.attempts} попыток: {error}") from error
+        print(f"Попытка {stats.attempts} для {stats.name} не удалась ({status or error}), "
+              f"повтор через {delay:.1f} с")
+        return delay
+
+    def _start_attempt(self, stats):
+        if not self.breaker.allow(stats):
+            raise CircuitOpenError("GigaChat временно недоступен (circuit breaker разомкнут)")
+        stats.attempts += 1
+
+    async def acall(self, name, request, deadline=None, model=None):
+        """
+        Выполняет request() с повторами; возвращает его результат или бросает LLMError.
+        request() возвращает awaitable, паузы между попытками не блокируют цикл событий.
+        """
+        deadline = self.deadline if deadline is None else deadline
+        stats = CallStats(name, model)
+        started = time.monotonic()
+        try:
+            while True:
+                self._start_attempt(stats)
+                try:
+                    result = await request()
+                except Exception as e:
+                    await asyncio.sleep(self._retry_delay(stats, e, started, deadline))
+                    continue
+                self.breaker.record_success()
+                stats.ok = True
+                stats.record_usage(result)
+                return result
+        except asyncio.CancelledError:
+            # Отменённый пробный запрос не должен оставить предохранитель разомкнутым навсегда
+            stats.cancelled = True
+            self.breaker.release_probe(stats)
+            raise
+        finally:
+            stats.latency = time.monotonic() - started
+            self._report(stats)
+
+    async def achat(self, name, prompt, deadline=None, model=None, max_tokens=None):
+        """Текст ответа модели на prompt; model=None — модель по умолчанию, max_tokens — ограничение длины ответа."""
+        payload = chat_payload(prompt, max_tokens)
+        response = await self.acall(name, lambda: self.client_getter(model).achat(payload), deadline, model)
+        return response.choices[0].message.content
+
+    async def achat_hedged(self, name, prompt, deadline=None, model=None, fallback_model=None, hedge_after=None,
+                           max_tokens=None):
+        """
+        achat с подстраховочным запросом: если model не ответила за hedge_after секунд
+        (или уже завершилась ошибкой), параллельно отправляется запрос к fallback_model.
+        Возвращает (текст, модель) первого успешного ответа, оставшийся запрос отменяется;
+        оба укладываются в общий дедлайн.
+        """
+        deadline = self.deadline if deadline is None else deadline
+        if not fallback_model or fallback_model == model or hedge_after is None or hedge_after >= deadline:
+            return await self.achat(name, prompt, deadline, model, max_tokens), model
+
+        async def answer(chosen, budget):
+            return await self.achat(name, prompt, budget, chosen, max_tokens), chosen
+
+        started = time.monotonic()
+        pending = {asyncio.ensure_future(answer(model, deadline))}
+        hedged = False
+        error = None
+        try:
+            while pending:
+                timeout = None if hedged else max(0.0, hedge_after - (time.monotonic() - started))
+                done, pending = await asyncio.wait(pending, timeout=timeout, return_when=asyncio.FIRST_COMPLETED)
+                for task in done:
+                    if task.exception() is None:
+                        return task.result()
+                    error = task.exception()
+                # Основной запрос не успел за hedge_after или уже упал — подключаем запасную модель
+                if not hedged and (not done or not pending):
+                    hedged = True
+                    elapsed = time.monotonic() - started
+                    if elapsed < deadline:
+                        print(f"{name}: {'ошибка' if done else 'нет ответа'} за {elapsed:.1f} с, "
+                              f"подстраховочный запрос к {fallback_model}")
+                        pending.add(asyncio.ensure_future(answer(fallback_model, deadline - elapsed)))
+            raise error
+        finally:
+            for task in pending:
+                task.cancel()
+
+    async def astream(self, name, prompt, deadline=None, model=None, max_tokens=None):
+        """Части ответа по мере генерации; повтор возможен только до первой части."""
+        payload = chat_payload(prompt, max_tokens)
+
+        async def open_stream():
+            chunks = self.client_getter(model).astream(payload).__aiter__()
+            async for chunk in chunks:
+                content = chunk.choices[0].delta.content
+                if content:
+                    return content, chunks
+            return None, chunks
+
+        first, chunks = await self.acall(name, open_stream, deadline, model)
+        if first is None:
+            return
+        yield first
+        try:
+            async for chunk in chunks:
+                content = chunk.choices[0].delta.content
+                if content:
+                    yield content
+        except Exception as e:
+            raise LLMError(f"поток прерван: {e}") from e
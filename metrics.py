@@ -0,0 +1,229 @@
+import os
+import time
+import threading
+import contextvars
+from collections import deque
+from contextlib import contextmanager
+from functools import wraps
+
+# Метрики процесса в текстовом формате Prometheus (отдаются на /metrics) и необязательные
+# трассировки: дерево вложенных интервалов (span) для каждой корневой операции.
+
+# Собирать трассировки (по умолчанию выключено) и сколько последних хранить в памяти
+TRACING = os.getenv("TRACING", "0") == "1"
+TRACE_HISTORY = int(os.getenv("TRACE_HISTORY", "100"))
+
+LATENCY_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10)
+LLM_BUCKETS = (0.5, 1, 2.5, 5, 10, 20, 30, 60, 120, 300)
+QUERY_COUNT_BUCKETS = (0, 1, 2, 5, 10, 20, 50, 100)
+
+
+def _escape(value):
+    return str(value).replace("\\", "\\\\").replace("\n", "\\n").replace('"', '\\"')
+
+
+def _labels(names, values, extra=()):
+    pairs = list(zip(names, values)) + list(extra)
+    if not pairs:
+        return ""
+    return "{" + ",".join(f'{name}="{_escape(value)}"' for name, value in pairs) + "}"
+
+
+def _number(value):
+    return repr(float(value)) if isinstance(value, float) else str(value)
+
+
+class Counter:
+    def __init__(self, name, documentation, labelnames=()):
+        self.name = name
+        self.documentation = documentation
+        self.labelnames = labelnames
+        self._values = {}
+        self._lock = threading.Lock()
+
+    def inc(self, *labels, amount=1):
+        with self._lock:
+            self._values[labels] = self._values.get(labels, 0) + amount
+
+    def render(self):
+        lines = [f"# HELP {self.name} {self.documentation}", f"# TYPE {self.name} counter"]
+        with self._lock:
+            for labels, value in sorted(self._values.items()):
+                lines.append(f"{self.name}{_labels(self.labelnames, labels)} {_number(value)}")
+        return lines
+
+
+class Histogram:
+    def __init__(self, name, documentation, labelnames=(), buckets=LATENCY_BUCKETS):
+        self.name = name
+        self.documentation = documentation
+        self.labelnames = labelnames
+        self.buckets = tuple(buckets)
+        # labels -> [счётчики по корзинам..., сумма, количество]
+        self._values = {}
+        self._lock = threading.Lock()
+
+    def observe(self, value, *labels):
+        with self._lock:
+            state = self._values.setdefault(labels, [0] * len(self.buckets) + [0.0, 0])
+            for index, bound in enumerate(self.buckets):
+                if value <= bound:
+                    state[index] += 1
+            state[-2] += value
+            state[-1] += 1
+
+    def render(self):
+        lines = [f"# HELP {self.name} {self.documentation}", f"# TYPE {self.name} histogram"]
+        with self._lock:
+            for labels, state in sorted(self._values.items()):
+                for bound, count in zip(self.buckets, state):
+                    lines.append(f"{self.name}_bucket{_labels(self.labelnames, labels, [('le', bound)])} {count}")
+                lines.append(f"{self.name}_bucket{_labels(self.labelnames, labels, [('le', '+Inf')])} {state[-1]}")
+                lines.append(f"{self.name}_sum{_labels(self.labelnames, labels)} {_number(state[-2])}")
+                lines.append(f"{self.name}_count{_labels(self.labelnames, labels)} {state[-1]}")
+        return lines
+
+
+REGISTRY = []
+
+
+def register(metric):
+    REGISTRY.append(metric)
+    return metric
+
+
+def render():
+    """Все метрики в текстовом формате Prometheus."""
+    lines = []
+    for metric in REGISTRY:
+        lines.extend(metric.render())
+    return "\n".join(lines) + "\n"
+
+
+llm_call_seconds = register(Histogram(
+    "syntaxway_llm_call_seconds", "Длительность вызова GigaChat с учётом повторов",
+    ("function", "model", "outcome"), LLM_BUCKETS))
+llm_attempts = register(Counter(
+    "syntaxway_llm_attempts_total", "Попытки запросов к GigaChat", ("function",)))
+llm_throttled = register(Counter(
+    "syntaxway_llm_throttled_total", "Ответы 429 от GigaChat", ("function",)))
+llm_tokens = register(Counter(
+    "syntaxway_llm_tokens_total", "Израсходованные токены GigaChat", ("function", "kind")))
+http_request_seconds = register(Histogram(
+    "syntaxway_http_request_seconds", "Длительность обработки запроса", ("endpoint", "method", "status")))
+db_queries_per_request = register(Histogram(
+    "syntaxway_db_queries_per_request", "Число SQL-запросов за HTTP-запрос", ("endpoint",), QUERY_COUNT_BUCKETS))
+db_time_per_request = register(Histogram(
+    "syntaxway_db_query_seconds_per_request", "Суммарное время SQL-запросов за HTTP-запрос", ("endpoint",)))
+db_queries = register(Counter(
+    "syntaxway_db_queries_total", "SQL-запросы по источнику (запрос пользователя или фоновый поток)", ("source",)))
+
+
+def observe_llm_call(stats):
+    """Слушатель LLMClient (llm.listeners): итог одного вызова модели."""
+    outcome = "ok" if stats.ok else "cancelled" if stats.cancelled else "error"
+    llm_call_seconds.observe(stats.latency, stats.name, stats.model or "", outcome)
+    llm_attempts.inc(stats.name, amount=stats.attempts)
+    if stats.throttled:
+        llm_throttled.inc(stats.name, amount=stats.throttled)
+    if stats.prompt_tokens or stats.completion_tokens:
+        llm_tokens.inc(stats.name, "prompt", amount=stats.prompt_tokens)
+        llm_tokens.inc(stats.name, "completion", amount=stats.completion_tokens)
+
+
+class RequestTracker:
+    """SQL-запросы текущего HTTP-запроса. Асинхронные представления видят его через копию контекста."""
+
+    def __init__(self, endpoint):
+        self.endpoint = endpoint
+        self.started = time.perf_counter()
+        self.queries = 0
+        self.query_time = 0.0
+
+
+current_request = contextvars.ContextVar("metrics_request", default=None)
+_query_started = contextvars.ContextVar("metrics_query_started", default=None)
+
+
+def start_request(endpoint):
+    current_request.set(RequestTracker(endpoint))
+
+
+def finish_request(tracker, method, status):
+    """Записывает метрики запроса; для потоковых ответов вызывается после отдачи тела."""
+    if tracker is None:
+        return
+    http_request_seconds.observe(time.perf_counter() - tracker.started, tracker.endpoint, method, status)
+    db_queries_per_request.observe(tracker.queries, tracker.endpoint)
+    db_time_per_request.observe(tracker.query_time, tracker.endpoint)
+
+
+def before_query(*args):
+    _query_started.set(time.perf_counter())
+
+
+def after_query(*args):
+    tracker = current_request.get()
+    started = _query_started.get()
+    db_queries.inc("request" if tracker else "background")
+    if tracker is not None:
+        tracker.queries += 1
+        if started is not None:
+            tracker.query_time += time.perf_counter() - started
+
+
+class Span:
+    def __init__(self, name, attributes):
+        self.name = name
+        self.attributes = attributes
+        self.started = time.perf_counter()
+        self.duration = None
+        self.children = []
+
+    def as_dict(self):
+        return {
+            "name": self.name,
+            "attributes": self.attributes,
+            "duration": self.duration,
+            "children": [child.as_dict() for child in self.children],
+        }
+
+
+traces = deque(maxlen=TRACE_HISTORY)
+_current_span = contextvars.ContextVar("metrics_span", default=None)
+
+
+def traced(name):
+    """Декоратор: вызов функции — интервал трассировки с именем name."""
+    def decorator(func):
+        @wraps(func)
+        def wrapper(*args, **kwargs):
+            with span(name):
+                return func(*args, **kwargs)
+        return wrapper
+    return decorator
+
+
+@contextmanager
+def span(name, **attributes):
+    """
+    Интервал трассировки, вложенный в текущий интервал этого потока (или корневой).
+    Завершённые корневые интервалы сохраняются в traces и печатаются одной строкой.
+    """
+    if not TRACING:
+        yield None
+        return
+    parent = _current_span.get()
+    current = Span(name, attributes)
+    if parent is not None:
+        parent.children.append(current)
+    token = _current_span.set(current)
+    try:
+        yield current
+    finally:
+        current.duration = time.perf_counter() - current.started
+        _current_span.reset(token)
+        if parent is None:
+            traces.append(current)
+            steps = ", ".join(f"{child.name} {child.duration:.1f} с" for child in current.children)
+            print(f"Трассировка {name} {attributes}: {current.duration:.1f} с" + (f" ({steps})" if steps else ""))
@@ -0,0 +1,227 @@
+import json
+from datetime import datetime
+from sqlalchemy import inspect, text
+
+import learning_stats
+
+# Версионированные миграции схемы. Каждая миграция выполняется один раз в своей транзакции,
+# номер применённой версии хранится в таблице schema_version.
+# Миграции идемпотентны: база, созданная с нуля по текущим моделям, проходит их без изменений.
+MIGRATIONS = []
+
+
+def migration(version, name):
+    def register(func):
+        MIGRATIONS.append((version, name, func))
+        MIGRATIONS.sort(key=lambda item: item[0])
+        return func
+    return register
+
+
+def table_columns(connection, table):
+    return {column["name"] for column in inspect(connection).get_columns(table)}
+
+
+def add_column_if_missing(connection, table, column, column_type):
+    if column not in table_columns(connection, table):
+        connection.execute(text(f"ALTER TABLE {table} ADD COLUMN {column} {column_type}"))
+
+
+def clear_empty_grades(connection):
+    # Старый код мог сохранить пустую строку вместо процента: такой день не оценён
+    for column in ("correct_percentage", "incorrect_percentage"):
+        connection.execute(text(
+            f"UPDATE training_data SET {column} = NULL WHERE CAST({column} AS TEXT) = ''"
+        ))
+
+
+@migration(1, "Базовая схема: создание отсутствующих таблиц")
+def create_tables(connection, db):
+    db.metadata.create_all(bind=connection)
+
+
+@migration(2, "Колонки контента: вариант промта, ключ ответов, тесты практических заданий")
+def add_content_columns(connection, db):
+    add_column_if_missing(connection, "generation_job", "variant", "INTEGER")
+    for table in ("training_data", "content_cache", "generation_job"):
+        add_column_if_missing(connection, table, "answer_key", "TEXT")
+        add_column_if_missing(connection, table, "practical_tests", "TEXT")
+
+
+@migration(3, "Составные индексы и уникальность (user_id, language, day)")
+def add_day_indexes(connection, db):
+    # Параллельные запросы могли создать несколько записей одного дня: оставляем самую полную
+    duplicates = connection.execute(text(
+        "SELECT user_id, language, day FROM training_data "
+        "GROUP BY user_id, language, day HAVING COUNT(*) > 1"
+    )).fetchall()
+    for user_id, language, day in duplicates:
+        rows = connection.execute(text(
+            "SELECT id FROM training_data WHERE user_id = :user_id AND day = :day "
+            "AND (language = :language OR (language IS NULL AND :language IS NULL)) "
+            "ORDER BY correct_percentage IS NOT NULL DESC, answers IS NOT NULL DESC, "
+            "material IS NOT NULL DESC, id DESC"
+        ), {"user_id": user_id, "language": language, "day": day}).fetchall()
+        for (row_id,) in rows[1:]:
+            connection.execute(text("DELETE FROM training_data WHERE id = :id"), {"id": row_id})
+
+    connection.execute(text(
+        "CREATE UNIQUE INDEX IF NOT EXISTS ix_training_data_user_language_day "
+        "ON training_data (user_id, language, day)"
+    ))
+    connection.execute(text(
+        "CREATE INDEX IF NOT EXISTS ix_summary_user_language_day ON summary (user_id, language, day)"
+    ))
+    connection.execute(text(
+        "CREATE INDEX IF NOT EXISTS ix_generation_job_user_language_day "
+        "ON generation_job (user_id, language, day)"
+    ))
+    connection.execute(text(
+        "CREATE INDEX IF NOT EXISTS ix_generation_job_status_priority ON generation_job (status, priority)"
+    ))
+
+
+@migration(4, "Таблица progress: текущий день и завершённость по (пользователь, язык)")
+def add_progress(connection, db):
+    db.metadata.tables["progress"].create(bind=connection, checkfirst=True)
+    clear_empty_grades(connection)
+    # Заполняем по последней записи каждого языка пользователя
+    connection.execute(text(
+        "INSERT INTO progress (user_id, language, last_day, last_day_graded, is_complete, updated_at) "
+        "SELECT t.user_id, t.language, t.day, t.correct_percentage IS NOT NULL, "
+        "t.day >= 30 AND t.correct_percentage IS NOT NULL, CURRENT_TIMESTAMP "
+        "FROM training_data t JOIN ("
+        "  SELECT user_id, language, MAX(day) AS day FROM training_data "
+        "  WHERE language IS NOT NULL GROUP BY user_id, language"
+        ") latest ON latest.user_id = t.user_id AND latest.language = t.language AND latest.day = t.day "
+        "WHERE NOT EXISTS (SELECT 1 FROM progress p WHERE p.user_id = t.user_id AND p.language = t.language)"
+    ))
+
+
+@migration(5, "Таблица rendered_markdown: HTML материалов и рекомендаций по хешу текста")
+def add_rendered_markdown(connection, db):
+    db.metadata.tables["rendered_markdown"].create(bind=connection, checkfirst=True)
+
+
+@migration(6, "Накопительная статистика курса в progress")
+def add_learning_stats(connection, db):
+    for column, column_type in (
+        ("graded_days", "INTEGER NOT NULL DEFAULT 0"),
+        ("correct_sum", "FLOAT NOT NULL DEFAULT 0"),
+        ("incorrect_sum", "FLOAT NOT NULL DEFAULT 0"),
+        ("correct_min", "FLOAT"),
+        ("correct_max", "FLOAT"),
+        ("streak", "INTEGER NOT NULL DEFAULT 0"),
+        ("best_streak", "INTEGER NOT NULL DEFAULT 0"),
+        ("histogram", "TEXT"),
+    ):
+        add_column_if_missing(connection, "progress", column, column_type)
+
+    # Заполняем по уже оценённым дням; база могла остановиться на версии 5 с пустыми строками
+    clear_empty_grades(connection)
+    courses = connection.execute(text("SELECT id, user_id, language FROM progress")).fetchall()
+    for progress_id, user_id, language in courses:
+        results = connection.execute(text(
+            "SELECT correct_percentage, incorrect_percentage FROM training_data "
+            "WHERE user_id = :user_id AND language = :language AND correct_percentage IS NOT NULL "
+            "ORDER BY day"
+        ), {"user_id": user_id, "language": language}).fetchall()
+        stats = learning_stats.compute(results)
+        stats["histogram"] = json.dumps(stats["histogram"])
+        connection.execute(text(
+            "UPDATE progress SET graded_days = :graded_days, correct_sum = :correct_sum, "
+            "incorrect_sum = :incorrect_sum, correct_min = :correct_min, correct_max = :correct_max, "
+            "streak = :streak, best_streak = :best_streak, histogram = :histogram WHERE id = :id"
+        ), dict(stats, id=progress_id))
+
+
+@migration(7, "Таблица content_blob и ссылки на сжатые тексты в training_data")
+def add_content_blobs(connection, db):
+    db.metadata.tables["content_blob"].create(bind=connection, checkfirst=True)
+    for column in ("material_blob", "questions_blob", "answers_blob"):
+        add_column_if_missing(connection, "training_data", column, "VARCHAR(64)")
+
+
+@migration(8, "Колонка question_items: разобранные вопросы дня")
+def add_question_items(connection, db):
+    for table in ("training_data", "content_cache", "generation_job"):
+        add_column_if_missing(connection, table, "question_items", "TEXT")
+
+
+@migration(9, "Таблица token_usage: расход токенов GigaChat по пользователям")
+def add_token_usage(connection, db):
+    db.metadata.tables["token_usage"].create(bind=connection, checkfirst=True)
+
+
+@migration(10, "Однократное выполнение: ключ действующей задачи генерации и таблица flight_lease")
+def add_single_flight(connection, db):
+    add_column_if_missing(connection, "generation_job", "dedup_key", "VARCHAR(120)")
+    # Ключ получает только последняя действующая задача каждого дня, иначе уникальный индекс не создастся
+    connection.execute(text(
+        "UPDATE generation_job SET dedup_key = user_id || ':' || language || ':' || day "
+        "WHERE id IN ("
+        "  SELECT (SELECT g.id FROM generation_job g "
+        "          WHERE g.user_id = j.user_id AND g.language = j.language AND g.day = j.day "
+        "            AND g.status IN ('queued', 'running', 'done') "
+        "          ORDER BY g.created_at DESC LIMIT 1) "
+        "  FROM generation_job j GROUP BY j.user_id, j.language, j.day"
+        ")"
+    ))
+    connection.execute(text(
+        "CREATE UNIQUE INDEX IF NOT EXISTS ix_generation_job_dedup_key ON generation_job (dedup_key)"
+    ))
+    db.metadata.tables["flight_lease"].create(bind=connection, checkfirst=True)
+
+
+@migration(11, "Таблица evaluation_cache: кэш оценок ответов нейросетью")
+def add_evaluation_cache(connection, db):
+    db.metadata.tables["evaluation_cache"].create(bind=connection, checkfirst=True)
+
+
+@migration(12, "Колонка grade_provisional: предварительная оценка без проверки нейросетью")
+def add_grade_provisional(connection, db):
+    add_column_if_missing(connection, "training_data", "grade_provisional", "BOOLEAN NOT NULL DEFAULT FALSE")
+
+
+@migration(13, "Частичный индекс предварительных оценок training_data")
+def add_grade_provisional_index(connection, db):
+    for index in db.metadata.tables["training_data"].indexes:
+        if index.name == "ix_training_data_grade_provisional":
+            index.create(bind=connection, checkfirst=True)
+
+
+def current_version(connection):
+    connection.execute(text(
+        "CREATE TABLE IF NOT EXISTS schema_version ("
+        "version INTEGER PRIMARY KEY, name VARCHAR(200), applied_at DATETIME)"
+    ))
+    return connection.execute(text("SELECT MAX(version) FROM schema_version")).scalar() or 0
+
+
+def upgrade(db):
+    """Применяет все ещё не применённые миграции; возвращает список их номеров."""
+    # Актуальная схема (обычный запуск процесса) проверяется одним запросом
+    with db.engine.begin() as connection:
+        if current_version(connection) >= MIGRATIONS[-1][0]:
+            return []
+    applied = []
+    for version, name, func in MIGRATIONS:
+        with db.engine.begin() as connection:
+            # Версию перечитываем в транзакции: миграцию мог применить другой процесс
+            if version <= current_version(connection):
+                continue
+            func(connection, db)
+            connection.execute(
+                text("INSERT INTO schema_version (version, name, applied_at) VALUES (:version, :name, :applied_at)"),
+                {"version": version, "name": name, "applied_at": datetime.utcnow()}
+            )
+            applied.append(version)
+            print(f"Применена миграция {version}: {name}")
+    return applied
+
+
+def status(db):
+    """Список (номер, описание, применена ли) для всех миграций."""
+    with db.engine.begin() as connection:
+        version = current_version(connection)
+    return [(number, name, number <= version) for number, name, _ in MIGRATIONS]
@@ -0,0 +1,175 @@
+import os
+import re
+import sys
+import shutil
+import signal
+import subprocess
+import tempfile
+from concurrent.futures import ThreadPoolExecutor
+
+try:
+    import pwd
+    import ctypes
+    import resource
+except ImportError:  # Windows: ограничения ресурсов недоступны, остаётся только таймаут
+    resource = None
+
+# Локальная проверка практических заданий запуском кода пользователя.
+# Выключена по умолчанию: код выполняется на сервере приложения от имени SANDBOX_USER,
+# без сети и с лимитами ресурсов (Linux), а не в контейнере
+SANDBOX_GRADING = os.getenv("SANDBOX_GRADING", "0") == "1"
+SANDBOX_TIMEOUT = float(os.getenv("SANDBOX_TIMEOUT", "5"))
+SANDBOX_CPU_SECONDS = int(os.getenv("SANDBOX_CPU_SECONDS", "3"))
+SANDBOX_MEMORY_MB = int(os.getenv("SANDBOX_MEMORY_MB", "256"))
+SANDBOX_OUTPUT_LIMIT = 64 * 1024
+SANDBOX_WORKERS = int(os.getenv("SANDBOX_WORKERS", "4"))
+# Процессов и потоков на пользователя, от имени которого выполняется код (RLIMIT_NPROC): защита от fork-бомбы
+SANDBOX_MAX_PROCESSES = int(os.getenv("SANDBOX_MAX_PROCESSES", "64"))
+# Непривилегированный пользователь для кода (приложению нужен root); у root по умолчанию — nobody.
+# Файлы приложения (.env, instance/) не должны быть доступны ему на чтение
+SANDBOX_USER = os.getenv("SANDBOX_USER", "nobody" if resource and os.geteuid() == 0 else "")
+# Запуск в отдельном сетевом пространстве имён без интерфейсов (Linux); если его не удаётся создать,
+# код не запускается. 0 — без изоляции сети: небезопасно на общих серверах
+SANDBOX_NO_NETWORK = os.getenv("SANDBOX_NO_NETWORK", "1") == "1"
+# Интерпретатор Python для кода: должен быть доступен SANDBOX_USER (виртуальное окружение в /root — нет)
+SANDBOX_PYTHON = os.getenv("SANDBOX_PYTHON", sys.executable)
+
+CLONE_NEWUSER = 0x10000000
+CLONE_NEWNET = 0x40000000
+# libc загружается заранее: в дочернем процессе между fork и exec только вызывается unshare
+_libc = ctypes.CDLL(None, use_errno=True) if resource else None
+
+_pool = ThreadPoolExecutor(max_workers=SANDBOX_WORKERS, thread_name_prefix="sandbox")
+
+
+def command_for(language):
+    """Команда интерпретатора и расширение файла для языка или None, если запуск невозможен."""
+    name = (language or "").strip().lower()
+    if name == "python":
+        # -I: изолированный режим без пользовательских site-packages и переменных PYTHON*
+        return [SANDBOX_PYTHON, "-I"], ".py"
+    if name in ("javascript", "js"):
+        node = shutil.which("node")
+        if node:
+            return [node, f"--max-old-space-size={SANDBOX_MEMORY_MB}"], ".js"
+    return None
+
+
+def supports(language):
+    return SANDBOX_GRADING and command_for(language) is not None
+
+
+def sandbox_ids():
+    """(uid, gid) пользователя SANDBOX_USER или None, если код выполняется от имени приложения."""
+    if not (resource and SANDBOX_USER):
+        return None
+    user = pwd.getpwnam(SANDBOX_USER)
+    if user.pw_uid == os.geteuid():
+        return None
+    return user.pw_uid, user.pw_gid
+
+
+def _isolate_network():
+    # От root достаточно нового сетевого пространства имён, иначе нужно и пространство пользователей
+    # (после смены пользователя в Popen код выполняется уже не от root)
+    flags = CLONE_NEWNET if os.geteuid() == 0 else CLONE_NEWUSER | CLONE_NEWNET
+    if _libc.unshare(flags) != 0:
+        errno = ctypes.get_errno()
+        raise OSError(errno, f"unshare: {os.strerror(errno)}")
+
+
+def _limit_resources(limit_memory):
+    # Пользователя меняет сам Popen (user=, group=), здесь — только сеть и лимиты
+    def apply():
+        if SANDBOX_NO_NETWORK:
+            _isolate_network()
+        resource.setrlimit(resource.RLIMIT_CPU, (SANDBOX_CPU_SECONDS, SANDBOX_CPU_SECONDS))
+        resource.setrlimit(resource.RLIMIT_FSIZE, (SANDBOX_OUTPUT_LIMIT, SANDBOX_OUTPUT_LIMIT))
+        resource.setrlimit(resource.RLIMIT_NPROC, (SANDBOX_MAX_PROCESSES, SANDBOX_MAX_PROCESSES))
+        if limit_memory:
+            memory = SANDBOX_MEMORY_MB * 1024 * 1024
+            resource.setrlimit(resource.RLIMIT_AS, (memory, memory))
+    return apply
+
+
+def strip_code_fences(code):
+    """Убирает обрамление ```lang ... ```, которое пользователи копируют из материала."""
+    match = re.search(r"```[\w+-]*\n(.*?)```", code, flags=re.DOTALL)
+    return match.group(1) if match else code
+
+
+def run_program(language, code, stdin=""):
+    """
+    Запускает код с stdin в отдельном процессе с лимитами; возвращает (успех, stdout).
+    Если процесс не удалось запустить с ограничениями, успех — None: код не проверен.
+    """
+    command, suffix = command_for(language)
+    ids = sandbox_ids()
+    with tempfile.TemporaryDirectory(prefix="syntaxway-") as workdir:
+        path = os.path.join(workdir, "main" + suffix)
+        with open(path, "w", encoding="utf-8") as f:
+            f.write(strip_code_fences(code))
+        if ids:
+            os.chown(workdir, *ids)
+            os.chown(path, *ids)
+        # V8 резервирует много виртуальной памяти, поэтому для node память ограничивается его флагом
+        preexec = _limit_resources(suffix == ".py") if resource else None
+        user = {"user": ids[0], "group": ids[1], "extra_groups": []} if ids else {}
+        try:
+            process = subprocess.Popen(
+                command + [path],
+                cwd=workdir,
+                env={"PATH": os.environ.get("PATH", ""), "PYTHONIOENCODING": "utf-8"},
+                stdin=subprocess.PIPE,
+                stdout=subprocess.PIPE,
+                stderr=subprocess.DEVNULL,
+                preexec_fn=preexec,
+                start_new_session=True,
+                **user
+            )
+        except (OSError, subprocess.SubprocessError) as e:
+            # Без изоляции код не запускаем; задание остаётся непроверенным и уходит нейросети
+            print(f"Песочница: не удалось запустить код с ограничениями ({e})")
+            return None, ""
+        try:
+            stdout, _ = process.communicate(stdin.encode("utf-8"), timeout=SANDBOX_TIMEOUT)
+        except subprocess.TimeoutExpired:
+            _kill(process)
+            return False, ""
+        # Процессы, порождённые программой и пережившие её, завершаются вместе с группой
+        _kill(process)
+        return process.returncode == 0, stdout[:SANDBOX_OUTPUT_LIMIT].decode("utf-8", errors="replace")
+
+
+def _kill(process):
+    try:
+        os.killpg(process.pid, signal.SIGKILL)
+    except (AttributeError, ProcessLookupError, PermissionError):
+        process.kill()
+    process.communicate()
+
+
+def _normalize_output(text):
+    return "\n".join(line.rstrip() for line in str(text).strip().splitlines())
+
+
+def passes_tests(language, code, tests):
+    """Код проходит все тесты вида {"input": ..., "output": ...}; None — код не удалось запустить."""
+    for test in tests:
+        ok, stdout = run_program(language, code, str(test.get("input", "")))
+        if ok is None:
+            return None
+        if not ok or _normalize_output(stdout) != _normalize_output(test.get("output", "")):
+            return False
+    return True
+
+
+def grade_tasks(language, tasks):
+    """
+    Проверяет задания параллельно, запуская не более SANDBOX_WORKERS процессов одновременно.
+    tasks: {номер: (код, тесты)}; возвращает {номер: True/False} без заданий, код которых
+    не удалось запустить, — их проверяет нейросеть.
+    """
+    futures = {num: _pool.submit(passes_tests, language, code, tests) for num, (code, tests) in tasks.items()}
+    results = {num: future.result() for num, future in futures.items()}
+    return {num: passed for num, passed in results.items() if passed is not None}
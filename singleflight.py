@@ -0,0 +1,38 @@
+import asyncio
+import threading
+import concurrent.futures
+
+# Объединение одновременных одинаковых вызовов в процессе: первый вызов с ключом выполняется,
+# остальные до его завершения ждут и получают тот же результат (или то же исключение).
+# Между процессами то же обеспечивает аренда ключа в базе (FlightLease в app.py).
+
+
+class SingleFlight:
+    def __init__(self):
+        self._calls = {}
+        self._lock = threading.Lock()
+
+    async def run(self, key, func):
+        """
+        Выполняет корутину func() один раз для одновременных вызовов с ключом key.
+        Ожидающие могут работать в других потоках и циклах событий: результат передаётся
+        через concurrent.futures.Future.
+        """
+        with self._lock:
+            future = self._calls.get(key)
+            leader = future is None
+            if leader:
+                future = self._calls[key] = concurrent.futures.Future()
+        if not leader:
+            return await asyncio.wrap_future(future)
+        try:
+            result = await func()
+        except BaseException as e:
+            future.set_exception(e)
+            raise
+        else:
+            future.set_result(result)
+            return result
+        finally:
+            with self._lock:
+                self._calls.pop(key, None)